@@ -0,0 +1,64 @@
+import bisect
+import datetime
+
+# Upper bounds (seconds) of the response-time histogram kept per consultant per day; the last
+# column counts everything slower. Changing the bounds would mix up the data already stored.
+RESPONSE_TIME_BUCKETS = (900, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600, 12 * 3600, 24 * 3600, 48 * 3600)
+LATENCY_COLUMNS = tuple(f"latency_{i}" for i in range(len(RESPONSE_TIME_BUCKETS) + 1))
+
+# Telegram rejects messages over 4096 characters.
+MESSAGE_CHUNK_SIZE = 4000
+
+def latency_column(seconds: int) -> str:
+    return LATENCY_COLUMNS[bisect.bisect_left(RESPONSE_TIME_BUCKETS, seconds)]
+
+def percentile(counts, q: float):
+    # Upper bound of the bucket holding the q-th percentile; inf for the overflow bucket, None without data.
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= rank:
+            return RESPONSE_TIME_BUCKETS[index] if index < len(RESPONSE_TIME_BUCKETS) else float("inf")
+    return float("inf")
+
+def format_duration(seconds) -> str:
+    if seconds is None:
+        return "-"
+    if seconds == float("inf"):
+        return f"> {RESPONSE_TIME_BUCKETS[-1] // 3600} ساعت"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} دقیقه"
+    return f"{seconds / 3600:.1f} ساعت"
+
+def parse_period(args, today: datetime.date):
+    # Returns (title, first_day, last_day) as ISO dates, or None for all-time; raises ValueError on bad input.
+    if not args or args == ["all"]:
+        return None
+    if args == ["today"]:
+        return "امروز", today.isoformat(), today.isoformat()
+    if args == ["week"]:
+        return "۷ روز اخیر", (today - datetime.timedelta(days=6)).isoformat(), today.isoformat()
+    if args == ["month"]:
+        return "ماه جاری", today.replace(day=1).isoformat(), today.isoformat()
+    if len(args) in (1, 2):
+        first, last = (datetime.date.fromisoformat(arg) for arg in (args[0], args[-1]))
+        if first > last:
+            raise ValueError("start date is after end date")
+        title = first.isoformat() if first == last else f"{first.isoformat()} تا {last.isoformat()}"
+        return title, first.isoformat(), last.isoformat()
+    raise ValueError("too many arguments")
+
+def chunk_report(blocks, limit: int = MESSAGE_CHUNK_SIZE):
+    # Joins report blocks into as few messages as possible without splitting a block.
+    chunk = ""
+    for block in blocks:
+        if chunk and len(chunk) + len(block) > limit:
+            yield chunk
+            chunk = ""
+        chunk += block
+    if chunk:
+        yield chunk
@@ -0,0 +1,57 @@
+import logging
+from db import claim_next_consultant_index, get_open_question_counts
+
+STRATEGIES = ("round_robin", "least_outstanding", "weighted")
+
+class AssignmentEngine:
+    """Picks a consultant for a new user and tracks each consultant's open questions in memory.
+
+    Selection and reservation happen without an await in between, so concurrent
+    updates on the event loop can never pick from the same snapshot.
+    """
+
+    def __init__(self, consultants, strategy: str = "round_robin", weights: dict = None):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown assignment strategy: {strategy}")
+        # Any iterable of ids; a ConsultantRegistry makes runtime changes apply to the next pick.
+        self.consultants = consultants
+        self.strategy = strategy
+        self.weights = weights or {}
+        self.open_questions = {}
+        self._cursor = 0
+
+    @property
+    def consultant_ids(self) -> list:
+        return list(self.consultants)
+
+    async def load(self, db):
+        self.open_questions = await get_open_question_counts(db)
+        logging.info(f"Assignment engine ({self.strategy}) loaded open questions: {self.open_questions}")
+
+    async def pick(self, db, exclude=()) -> int:
+        consultant_ids = self.consultant_ids
+        candidates = [cid for cid in consultant_ids if cid not in exclude] or consultant_ids
+        if self.strategy == "round_robin" and not exclude:
+            index = await claim_next_consultant_index(db, len(consultant_ids))
+            consultant_id = consultant_ids[index]
+        elif self.strategy == "weighted":
+            consultant_id = self._least_loaded(candidates, lambda cid: self.open_questions.get(cid, 0) / self.weights.get(cid, 1))
+        else:
+            consultant_id = self._least_loaded(candidates, lambda cid: self.open_questions.get(cid, 0))
+        self.reserve(consultant_id)
+        return consultant_id
+
+    def _least_loaded(self, candidates, load):
+        # Ties are broken by a rotating cursor so an idle team is still filled evenly.
+        n = len(candidates)
+        start = self._cursor % n
+        self._cursor += 1
+        ordered = candidates[start:] + candidates[:start]
+        return min(ordered, key=load)
+
+    def reserve(self, consultant_id: int):
+        self.open_questions[consultant_id] = self.open_questions.get(consultant_id, 0) + 1
+
+    def release(self, consultant_id: int):
+        if self.open_questions.get(consultant_id, 0) > 0:
+            self.open_questions[consultant_id] -= 1
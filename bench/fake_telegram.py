@@ -0,0 +1,120 @@
+import asyncio
+import html
+import json
+import re
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+class FakeTelegramServer:
+    """Local stand-in for the Bot API methods the bot uses, with a fixed latency per call.
+
+    Updates pushed with `push_update` are served through getUpdates; every message the bot
+    sends is recorded per chat and can be awaited with `next_message`.
+    """
+
+    def __init__(self, latency: float = 0.0, host: str = "127.0.0.1", port: int = 8081):
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.calls = defaultdict(int)
+        self._updates = []
+        self._update_id = 0
+        self._new_updates = asyncio.Event()
+        self._message_id = 0
+        self._inboxes = defaultdict(asyncio.Queue)
+        self._runner = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def push_update(self, payload: dict):
+        self._update_id += 1
+        self._updates.append({"update_id": self._update_id, **payload})
+        self._new_updates.set()
+
+    async def next_message(self, chat_id: int, timeout: float = 30) -> dict:
+        return await asyncio.wait_for(self._inboxes[chat_id].get(), timeout)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        handler = getattr(self, f"_method_{method}", None)
+        result = await handler(params) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _method_getme(self, params):
+        return BOT_USER
+
+    async def _method_getupdates(self, params):
+        offset = int(params.get("offset", 0))
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params.get("timeout", 0)) or 0.1)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit", 100))
+        return self._updates[:limit]
+
+    async def _method_sendmessage(self, params):
+        self._message_id += 1
+        chat_id = int(params["chat_id"])
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            # Like Telegram, deliver the text with the HTML markup already parsed out.
+            "text": html.unescape(re.sub(r"<[^>]+>", "", params.get("text", ""))),
+        }
+        if params.get("reply_markup"):
+            message["reply_markup"] = json.loads(params["reply_markup"])
+        self._inboxes[chat_id].put_nowait(message)
+        return message
+
+    async def _method_senddocument(self, params):
+        self._message_id += 1
+        chat_id = int(params["chat_id"])
+        document = params.get("document")
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "caption": params.get("caption", ""),
+            "document": {"file_id": f"document{self._message_id}", "file_unique_id": f"document{self._message_id}",
+                         "file_name": getattr(document, "filename", None)},
+            "text": params.get("caption", ""),
+        }
+        self._inboxes[chat_id].put_nowait(message)
+        return message
+
+    async def _method_getchatmember(self, params):
+        user_id = int(params["user_id"])
+        return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "User"}}
+
+def asker_id(forwarded_text: str):
+    # Forwarded questions carry the asker's id in a <code> block.
+    match = re.search(r"(\d+)", forwarded_text.split("آیدی کاربر:", 1)[-1])
+    return int(match.group(1)) if match else None
@@ -0,0 +1,241 @@
+"""End-to-end load test: drives the real dispatcher and routers against a fake Bot API server.
+
+Usage (from the repository root):
+    python -m bench.run --users 500 --consultants 5 --latency-ms 20
+    python -m bench.run --save-baseline            # store results as bench/baseline.json
+    python -m bench.run --baseline bench/baseline.json   # compare against a stored run
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_OUTPUT = os.path.join(REPO_ROOT, "bench", "results", "latest.json")
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, "bench", "baseline.json")
+
+OWNER_ID = 1
+CONSULTANT_ID_BASE = 1000
+USER_ID_BASE = 100000
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="number of synthetic users")
+    parser.add_argument("--consultants", type=int, default=5, help="number of synthetic consultants")
+    parser.add_argument("--concurrency", type=int, default=100, help="users running their flow at the same time")
+    parser.add_argument("--latency-ms", type=float, default=0, help="latency of every fake Bot API call")
+    parser.add_argument("--port", type=int, default=8081, help="port of the fake Bot API server")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="keep the outbox at Telegram's real rate limits instead of lifting them")
+    parser.add_argument("--label", default="local", help="name stored with the results")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="where to write the results JSON")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help=f"also write the results to {DEFAULT_BASELINE}")
+    return parser.parse_args()
+
+def configure_environment(args, server_url: str):
+    # config.py reads the environment at import time, so this must run before importing the bot.
+    os.environ.update({
+        "BOT_TOKEN_PSYCHOLOGY": "123456:BENCHMARK",
+        "OWNER_ID": str(OWNER_ID),
+        "CONSULTANT_IDS_PSYCHOLOGY": ",".join(str(CONSULTANT_ID_BASE + i) for i in range(args.consultants)),
+        "TELEGRAM_API_URL": server_url,
+        "RUN_MODE": "polling",
+        "METRICS_PORT": "0",
+        # Synthetic users type faster than people; the throttle would only measure itself.
+        "THROTTLE_MESSAGE_RATE": "1000",
+    })
+    if not args.telegram_limits:
+        os.environ.update({"OUTBOX_GLOBAL_RATE": "100000", "OUTBOX_CHAT_RATE": "100000", "OUTBOX_CHAT_BURST": "100000"})
+    sys.path.insert(0, REPO_ROOT)
+
+def percentiles(samples) -> dict:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)] * 1000, 3)
+
+    return {"p50": pick(50), "p95": pick(95), "p99": pick(99)}
+
+class LatencyRecorder:
+    def __init__(self):
+        self.updates = []
+        self.handlers = defaultdict(list)
+
+    def update_middleware(self):
+        async def middleware(handler, event, data):
+            started = time.perf_counter()
+            try:
+                return await handler(event, data)
+            finally:
+                self.updates.append(time.perf_counter() - started)
+        return middleware
+
+    def handler_middleware(self):
+        async def middleware(handler, event, data):
+            started = time.perf_counter()
+            try:
+                return await handler(event, data)
+            finally:
+                handler_object = data.get("handler")
+                name = handler_object.callback.__name__ if handler_object else "unknown"
+                self.handlers[name].append(time.perf_counter() - started)
+        return middleware
+
+def message_update(user_id: int, text: str, reply_to: dict = None) -> dict:
+    message = {
+        "message_id": int(time.time() * 1000) % 1_000_000_000,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"},
+        "text": text,
+    }
+    if reply_to:
+        message["reply_to_message"] = reply_to
+    return {"message": message}
+
+def callback_update(user_id: int, data: str, message: dict) -> dict:
+    return {"callback_query": {
+        "id": str(time.time_ns()),
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"},
+        "chat_instance": str(user_id),
+        "message": message,
+        "data": data,
+    }}
+
+async def wait_for_text(server, chat_id: int, fragment: str) -> dict:
+    while True:
+        message = await server.next_message(chat_id)
+        if fragment in message["text"]:
+            return message
+
+async def user_flow(server, user_id: int):
+    for text in ("/start", "Bench User", "09123456789", "Tehran"):
+        server.push_update(message_update(user_id, text))
+        await server.next_message(user_id)
+    server.push_update(message_update(user_id, f"Benchmark question from {user_id}"))
+    answer = await wait_for_text(server, user_id, "پاسخ از طرف مشاور")
+    # A follow-up question, half of the users through /ask and half through the button under the answer.
+    if user_id % 2:
+        server.push_update(message_update(user_id, "/ask"))
+    else:
+        server.push_update(callback_update(user_id, "ask_new_question", answer))
+    await wait_for_text(server, user_id, "سوال خود را")
+    server.push_update(message_update(user_id, f"Second benchmark question from {user_id}"))
+    await wait_for_text(server, user_id, "پاسخ از طرف مشاور")
+
+async def consultant_loop(server, consultant_id: int):
+    from bench.fake_telegram import asker_id
+    while True:
+        message = await server.next_message(consultant_id, timeout=3600)
+        if "درخواست مشاوره جدید" not in message["text"] or asker_id(message["text"]) is None:
+            continue
+        server.push_update(message_update(consultant_id, "Benchmark answer", reply_to=message))
+
+async def run(args) -> dict:
+    from bench.fake_telegram import FakeTelegramServer
+
+    server = FakeTelegramServer(latency=args.latency_ms / 1000, port=args.port)
+    configure_environment(args, server.url)
+    await server.start()
+
+    import main
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.chdir(workdir)
+
+    session = main.create_session()
+    bot_config = main.BOTS[0]
+    bot = main.create_bot(bot_config, session)
+    await main.prepare_database(bot, bot_config)
+    recorder = LatencyRecorder()
+    async with main.open_database(bot_config) as db:
+        context = await main.create_bot_context(bot, bot_config, db)
+        storage = await main.create_fsm_storage()
+        dp = main.create_dispatcher(storage, {bot.id: context})
+        dp.update.outer_middleware(recorder.update_middleware())
+        dp.message.middleware(recorder.handler_middleware())
+        dp.callback_query.middleware(recorder.handler_middleware())
+
+        polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False))
+        consultants = [asyncio.create_task(consultant_loop(server, CONSULTANT_ID_BASE + i)) for i in range(args.consultants)]
+
+        commits_before = db.commit_count
+        fsm_commits_before = getattr(storage, "commit_count", 0)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited_flow(user_id):
+            async with semaphore:
+                await user_flow(server, user_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited_flow(USER_ID_BASE + i) for i in range(args.users)))
+        duration = time.perf_counter() - started
+
+        for task in consultants:
+            task.cancel()
+        await dp.stop_polling()
+        await polling
+        await main.stop_bot_context(context)
+
+        results = {
+            "label": args.label,
+            "users": args.users,
+            "consultants": args.consultants,
+            "concurrency": args.concurrency,
+            "api_latency_ms": args.latency_ms,
+            "telegram_limits": args.telegram_limits,
+            "duration_s": round(duration, 3),
+            "updates": len(recorder.updates),
+            "updates_per_sec": round(len(recorder.updates) / duration, 2),
+            "update_latency_ms": percentiles(recorder.updates),
+            "handlers": {name: {"count": len(samples), **percentiles(samples)}
+                         for name, samples in sorted(recorder.handlers.items())},
+            "sqlite_commits": db.commit_count - commits_before,
+            "fsm_commits": getattr(storage, "commit_count", 0) - fsm_commits_before,
+            "api_calls": dict(server.calls),
+        }
+    await storage.close()
+    await session.close()
+    await server.stop()
+    return results
+
+def compare(results: dict, baseline: dict):
+    print(f"\nCompared with baseline '{baseline.get('label')}':")
+
+    def line(name, current, previous, higher_is_better):
+        if not previous or current is None:
+            return
+        change = (current - previous) / previous * 100
+        better = change > 0 if higher_is_better else change < 0
+        print(f"  {name:<24} {previous:>10} -> {current:<10} ({change:+.1f}%{'' if better or change == 0 else ', REGRESSION'})")
+
+    line("updates/sec", results["updates_per_sec"], baseline.get("updates_per_sec"), True)
+    for p in ("p50", "p95", "p99"):
+        line(f"update latency {p} (ms)", results["update_latency_ms"][p], baseline.get("update_latency_ms", {}).get(p), False)
+    line("sqlite commits", results["sqlite_commits"], baseline.get("sqlite_commits"), False)
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(DEFAULT_BASELINE, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aiogram import Bot
+
+from db import (count_broadcast_recipients, get_broadcast_recipients, create_broadcast, get_running_broadcast,
+                set_broadcast_progress_message, checkpoint_broadcast, finish_broadcast)
+from metrics import BROADCAST_MESSAGES
+from outbox import Outbox, PRIORITY_BROADCAST, PRIORITY_PROMPT
+
+# Pages queued in the outbox at once; the next page is read while the previous one is still being sent.
+PAGES_IN_FLIGHT = 2
+
+class BroadcastEngine:
+    """Sends the owner's announcements to every user who hasn't blocked the bot.
+
+    Recipients are read page by page in user_id order and queued in the outbox at the lowest
+    priority, so broadcasts use the bot-wide rate limit without delaying answers or questions.
+    After each page the last user_id and counters are checkpointed; a restart resumes from the
+    last checkpoint, so only the pages that were in flight can be delivered twice.
+    """
+
+    def __init__(self, bot: Bot, db, outbox: Outbox, page_size: int = 200, progress_interval: float = 5):
+        self.bot = bot
+        self.db = db
+        self.outbox = outbox
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, text: str, owner_chat_id: int):
+        # Returns the new broadcast id, or None if another broadcast is still running.
+        if self.running:
+            return None
+        total = await count_broadcast_recipients(self.db)
+        broadcast_id = await create_broadcast(self.db, text, total, owner_chat_id)
+        if broadcast_id is None:
+            return None
+        self._task = asyncio.create_task(self._run(await get_running_broadcast(self.db)))
+        return broadcast_id
+
+    async def resume(self):
+        row = await get_running_broadcast(self.db)
+        if row and not self.running:
+            logging.info(f"Resuming broadcast {row[0]} after user {row[2]}")
+            self._task = asyncio.create_task(self._run(row))
+
+    async def cancel(self) -> bool:
+        # Marks the broadcast cancelled; the sender notices at its next checkpoint.
+        row = await get_running_broadcast(self.db)
+        return bool(row) and await finish_broadcast(self.db, row[0], "cancelled")
+
+    async def stop(self):
+        # Shutdown only: the broadcast stays 'running' in the database and resumes on the next start.
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self, row):
+        broadcast_id, text, last_user_id, total, sent, failed, chat_id, progress_message_id, _ = row
+        resumed_from = sent + failed
+        started = time.monotonic()
+        last_report = 0
+
+        async def report(title: str):
+            nonlocal progress_message_id
+            done = sent + failed
+            elapsed = time.monotonic() - started
+            rate = (done - resumed_from) / elapsed if elapsed > 0 else 0
+            remaining = max(total - done, 0)
+            eta = f"{remaining / rate / 60:.0f} دقیقه" if rate > 0 and remaining else "-"
+            progress = (
+                f"📣 <b>{title}</b> (#{broadcast_id})\n\n"
+                f"📊 پیشرفت: {done}/{max(total, done)} ({done / max(total, done, 1):.0%})\n"
+                f"✅ ارسال شده: {sent}\n"
+                f"❌ ناموفق: {failed}\n"
+                f"⚡️ سرعت: {rate:.1f} پیام در ثانیه\n"
+                f"⏳ زمان باقی‌مانده: {eta}"
+            )
+            try:
+                if progress_message_id:
+                    await self.bot.edit_message_text(progress, chat_id=chat_id, message_id=progress_message_id)
+                else:
+                    message = await (await self.outbox.send(chat_id, progress, PRIORITY_PROMPT, durable=False))
+                    if message:
+                        progress_message_id = message.message_id
+                        await set_broadcast_progress_message(self.db, broadcast_id, progress_message_id)
+            except Exception as e:
+                logging.warning(f"Could not update progress of broadcast {broadcast_id}: {e}")
+
+        try:
+            await report("ارسال پیام همگانی در حال انجام است")
+            in_flight = deque()
+            exhausted = False
+            while True:
+                while not exhausted and len(in_flight) < PAGES_IN_FLIGHT:
+                    after = in_flight[-1][0] if in_flight else last_user_id
+                    page = await get_broadcast_recipients(self.db, after, self.page_size)
+                    if not page:
+                        exhausted = True
+                        break
+                    deliveries = [await self.outbox.send(user_id, text, PRIORITY_BROADCAST, durable=False) for user_id in page]
+                    in_flight.append((page[-1], deliveries))
+                if not in_flight:
+                    break
+
+                last_user_id, deliveries = in_flight.popleft()
+                results = await asyncio.gather(*deliveries)
+                delivered = sum(1 for message in results if message is not None)
+                sent += delivered
+                failed += len(results) - delivered
+                BROADCAST_MESSAGES.inc("sent", amount=delivered)
+                BROADCAST_MESSAGES.inc("failed", amount=len(results) - delivered)
+
+                if not await checkpoint_broadcast(self.db, broadcast_id, last_user_id, sent, failed):
+                    # Whatever is already queued is still sent; nothing new is read.
+                    await report("ارسال پیام همگانی لغو شد")
+                    return
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    await report("ارسال پیام همگانی در حال انجام است")
+
+            await finish_broadcast(self.db, broadcast_id, "done")
+            await report("ارسال پیام همگانی به پایان رسید")
+        except Exception as e:
+            logging.error(f"Broadcast {broadcast_id} stopped at user {last_user_id}: {e}")
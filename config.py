@@ -3,24 +3,127 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-API_TOKEN = os.getenv("BOT_TOKEN_PSYCHOLOGY")
-OWNER_ID = int(os.getenv("OWNER_ID"))
+# Optional Bot API server (e.g. a local telegram-bot-api instance or the benchmark's fake server)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 
-CONSULTANT_IDS_STR = os.getenv("CONSULTANT_IDS_PSYCHOLOGY", "")
-if not CONSULTANT_IDS_STR:
-    raise ValueError("حداقل یک آیدی مشاور در فایل .env در متغیر CONSULTANT_IDS_PSYCHOLOGY نیاز است.")
-
-CONSULTANT_IDS = [int(cid.strip()) for cid in CONSULTANT_IDS_STR.split(',')]
-
-
-CHANNELS = ['@aiimpact_ir', '@ai_agent_farsi']
+# Defaults shared by every bot; each can be overridden per bot with a _<NAME> suffix (e.g. MESSAGE_LIMIT_PSYCHOLOGY)
+DEFAULT_CHANNELS = "@aiimpact_ir,@ai_agent_farsi"
 MESSAGE_LIMIT = 2
-
-LIMIT_REACHED_MESSAGE = (
-    "⚠️ شما به حداکثر پیام های مشاوره روانشناسی خود در این ماه رسیده اید\n\n"
-    "برای دریافت مشاوره بیشتر، لطفاً با شماره‌های زیر تماس بگیرید:\n"
+# round_robin, least_outstanding or weighted
+ASSIGNMENT_STRATEGY = "round_robin"
+# Field of consultation shown to users and consultants (BOT_TOPIC), and the contact details shown once the quota is used up (CONTACT_INFO)
+BOT_TOPIC = "روانشناسی"
+CONTACT_INFO = (
     "📞 <b>021-88785701</b>\n"
     "📱 <b>0999-1044844</b>\n"
     "لینک درخواست مشاوره از سایت: \n"
     "https://toofanpsy.ir/contact"
-)
\ No newline at end of file
+)
+# "calendar_month" or "rolling" (questions asked in the last QUOTA_ROLLING_DAYS); users may have their own limit set with /setlimit
+QUOTA_WINDOW = os.getenv("QUOTA_WINDOW", "calendar_month")
+QUOTA_ROLLING_DAYS = int(os.getenv("QUOTA_ROLLING_DAYS", "30"))
+
+def _bot_env(name: str, key: str, default=None):
+    return os.getenv(f"{key}_{name}", os.getenv(key, default))
+
+class BotConfig:
+    """Settings of one hosted bot, read from the variables suffixed with its name."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.token = os.getenv(f"BOT_TOKEN_{name}")
+        if not self.token:
+            raise ValueError(f"توکن ربات {name} در متغیر BOT_TOKEN_{name} فایل .env تعریف نشده است.")
+        self.owner_id = int(_bot_env(name, "OWNER_ID"))
+
+        consultant_ids = os.getenv(f"CONSULTANT_IDS_{name}", "")
+        if not consultant_ids:
+            raise ValueError(f"حداقل یک آیدی مشاور در فایل .env در متغیر CONSULTANT_IDS_{name} نیاز است.")
+        self.consultant_ids = [int(cid.strip()) for cid in consultant_ids.split(',')]
+        self.assignment_strategy = _bot_env(name, "ASSIGNMENT_STRATEGY", ASSIGNMENT_STRATEGY)
+        # Format: "consultant_id:weight,..." (only used by the weighted strategy, default weight is 1)
+        self.consultant_weights = {
+            int(cid): float(weight)
+            for cid, weight in (item.split(':') for item in _bot_env(name, "CONSULTANT_WEIGHTS", "").split(',') if item.strip())
+        }
+        if any(weight <= 0 for weight in self.consultant_weights.values()):
+            raise ValueError(f"وزن مشاوران در CONSULTANT_WEIGHTS ربات {name} باید بزرگ‌تر از صفر باشد؛ برای کنار گذاشتن یک مشاور، آن را از فهرست مشاوران حذف کنید.")
+
+        self.channels = [c.strip() for c in _bot_env(name, "CHANNELS", DEFAULT_CHANNELS).split(',') if c.strip()]
+        self.message_limit = int(_bot_env(name, "MESSAGE_LIMIT", MESSAGE_LIMIT))
+
+        # Texts that name the bot's field; WELCOME_MESSAGE and LIMIT_REACHED_MESSAGE replace the defaults entirely.
+        self.topic = _bot_env(name, "BOT_TOPIC", BOT_TOPIC)
+        self.welcome_message = _bot_env(name, "WELCOME_MESSAGE", f"سلام! به ربات مشاوره {self.topic} خوش آمدید. 👋")
+        self.limit_reached_message = _bot_env(
+            name, "LIMIT_REACHED_MESSAGE",
+            f"⚠️ شما به حداکثر پیام های مشاوره {self.topic} خود رسیده اید\n\n"
+            f"برای دریافت مشاوره بیشتر، لطفاً با شماره‌های زیر تماس بگیرید:\n"
+            f"{_bot_env(name, 'CONTACT_INFO', CONTACT_INFO)}"
+        )
+        # Every bot keeps its users, questions and stats in its own database file.
+        self.db_file = os.getenv(f"DB_FILE_{name}", f"{name.lower()}_bot.db")
+
+# Names of the bots hosted by this process, e.g. BOTS=PSYCHOLOGY,CAREER
+BOTS = [BotConfig(name.strip().upper()) for name in os.getenv("BOTS", "PSYCHOLOGY").split(',') if name.strip()]
+# How often webhook workers check for consultant list changes made with /consultants in another worker (seconds)
+CONSULTANTS_REFRESH_INTERVAL = float(os.getenv("CONSULTANTS_REFRESH_INTERVAL", "30"))
+
+# Subscription check cache (seconds for TTLs)
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "10000"))
+SUBSCRIPTION_CACHE_TTL = int(os.getenv("SUBSCRIPTION_CACHE_TTL", "600"))
+SUBSCRIPTION_CACHE_NEGATIVE_TTL = int(os.getenv("SUBSCRIPTION_CACHE_NEGATIVE_TTL", "30"))
+
+# Serving mode: "polling" or "webhook"
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+# FSM state is persisted to SQLite unless FSM_REDIS_URL is set (requires the optional "redis" package)
+FSM_REDIS_URL = os.getenv("FSM_REDIS_URL")
+FSM_DB_FILE = os.getenv("FSM_DB_FILE", "fsm_state.db")
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+# Registration flows left untouched for this many seconds are discarded
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+
+if RUN_MODE == "webhook" and not WEBHOOK_BASE_URL:
+    raise ValueError("در حالت webhook مقدار WEBHOOK_BASE_URL در فایل .env الزامی است.")
+
+# Per-user flood limits: sustained updates per second and burst size (owner and consultants are exempt)
+THROTTLE_MESSAGE_RATE = float(os.getenv("THROTTLE_MESSAGE_RATE", "1"))
+THROTTLE_MESSAGE_BURST = int(os.getenv("THROTTLE_MESSAGE_BURST", "5"))
+THROTTLE_CALLBACK_RATE = float(os.getenv("THROTTLE_CALLBACK_RATE", "0.5"))
+THROTTLE_CALLBACK_BURST = int(os.getenv("THROTTLE_CALLBACK_BURST", "3"))
+
+# Number of user profiles kept in memory in front of the users table
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+
+# Outgoing message limits (messages per second); Telegram allows about 30/s overall and 1/s per chat
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "3"))
+
+# Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics (0 disables; webhook workers use METRICS_PORT + index)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Exposes /debug/profile?seconds=N on the metrics port (sampled stacks in flame graph format)
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+
+# Combine commits from concurrent updates into one every N milliseconds (0 disables)
+DB_GROUP_COMMIT_MS = int(os.getenv("DB_GROUP_COMMIT_MS", "0"))
+# Read-only connections used for SELECTs; writes always go through a single writer connection
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+
+# Unanswered questions: remind the consultant after N hours, hand the question to another consultant after M hours
+SLA_REMIND_AFTER_HOURS = float(os.getenv("SLA_REMIND_AFTER_HOURS", "12"))
+SLA_REASSIGN_AFTER_HOURS = float(os.getenv("SLA_REASSIGN_AFTER_HOURS", "24"))
+# How often non-scheduling webhook workers' new questions are picked up by the scheduler (seconds)
+SLA_SYNC_INTERVAL = int(os.getenv("SLA_SYNC_INTERVAL", "60"))
+
+# Owner broadcasts read recipients in pages of this size and checkpoint after each page
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+# Seconds between edits of the owner's broadcast progress message
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+
+from aiogram.filters import Filter
+from aiogram.types import TelegramObject
+
+from db import get_active_consultants, get_setting, replace_consultants
+
+class ConsultantRegistry:
+    """The current consultants of one bot, changeable while the bot runs.
+
+    `ids` keeps the assignment order and a frozenset answers membership in O(1); a change
+    swaps both at once, so handlers never see a half-updated list. Changes are stored in
+    the bot's database and other processes pick them up through `watch`.
+    """
+
+    def __init__(self, consultant_ids=()):
+        self.version = None
+        self._watcher = None
+        self._set(consultant_ids)
+
+    def _set(self, consultant_ids):
+        self.ids = tuple(dict.fromkeys(consultant_ids))
+        self._members = frozenset(self.ids)
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._members
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    async def load(self, db):
+        self.version = await get_setting(db, "consultants_version")
+        consultant_ids = await get_active_consultants(db)
+        if consultant_ids:
+            self._set(consultant_ids)
+
+    async def replace(self, db, consultant_ids):
+        await replace_consultants(db, consultant_ids)
+        await self.load(db)
+
+    async def refresh(self, db) -> bool:
+        # One settings lookup; the list itself is only read again when its version changed.
+        if await get_setting(db, "consultants_version") == self.version:
+            return False
+        await self.load(db)
+        logging.info(f"Consultant list reloaded: {list(self.ids)}")
+        return True
+
+    def watch(self, db, interval: float):
+        async def run():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.refresh(db)
+                except Exception as e:
+                    logging.error(f"Could not reload the consultant list: {e}")
+        self._watcher = asyncio.create_task(run())
+
+    async def stop(self):
+        if self._watcher:
+            self._watcher.cancel()
+
+class IsConsultant(Filter):
+    # Replaces F.from_user.id.in_(...): the list comes from the bot that received the update.
+    async def __call__(self, event: TelegramObject, consultants: ConsultantRegistry) -> bool:
+        return event.from_user is not None and event.from_user.id in consultants
+
+class IsOwner(Filter):
+    async def __call__(self, event: TelegramObject, bot_config) -> bool:
+        return event.from_user is not None and event.from_user.id == bot_config.owner_id
@@ -1,9 +1,392 @@
+import asyncio
+import contextvars
+import datetime
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 import aiosqlite
-from config import CONSULTANT_IDS
+from config import USER_CACHE_SIZE
+from metrics import DB_QUERY_SECONDS, DB_COMMITS
+from analytics import RESPONSE_TIME_BUCKETS, LATENCY_COLUMNS, latency_column
 
-DB_FILE = "psychology_bot.db"
+# True while the current task is inside unit_of_work(); commits are then deferred to its exit.
+_in_unit_of_work = contextvars.ContextVar("in_unit_of_work", default=False)
+# The open unit of work of the current task; its statements bypass the shared write queue.
+_transaction = contextvars.ContextVar("transaction", default=None)
+_USER_FIELDS = ("full_name", "phone_number", "city", "message_count", "quota_period_start", "assigned_consultant_id", "quota_limit",
+                "is_blocked")
 
-async def create_all_tables(db: aiosqlite.Connection):
+class UserCache:
+    """Bounded LRU of the rows returned by get_or_create_user, kept current by every users write."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+
+    def get(self, user_id: int):
+        row = self._rows.get(user_id)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._rows.move_to_end(user_id)
+        return row
+
+    def set(self, user_id: int, row: tuple):
+        if self.max_size <= 0:
+            return
+        self._rows[user_id] = tuple(row)
+        self._rows.move_to_end(user_id)
+        while len(self._rows) > self.max_size:
+            self._rows.popitem(last=False)
+
+    def patch(self, user_id: int, **fields):
+        row = self._rows.get(user_id)
+        if row is None:
+            return
+        row = list(row)
+        for name, value in fields.items():
+            row[_USER_FIELDS.index(name)] = value
+        self._rows[user_id] = tuple(row)
+
+    def invalidate(self, user_id: int):
+        self._rows.pop(user_id, None)
+
+    def clear(self):
+        self._rows.clear()
+
+    def resize(self, max_size: int):
+        self.max_size = max_size
+        while len(self._rows) > max(max_size, 0):
+            self._rows.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._rows), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+class _BufferedCursor:
+    # Rows are fetched eagerly, so the connection is free again by the time the caller reads them.
+
+    def __init__(self, rows, lastrowid=None, rowcount=-1):
+        self._rows = rows
+        self._index = 0
+        self.lastrowid = lastrowid
+        self.rowcount = rowcount
+
+    async def fetchone(self):
+        if self._index >= len(self._rows):
+            return None
+        row = self._rows[self._index]
+        self._index += 1
+        return row
+
+    async def fetchall(self):
+        rows = self._rows[self._index:]
+        self._index = len(self._rows)
+        return rows
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        row = await self.fetchone()
+        if row is None:
+            raise StopAsyncIteration
+        return row
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+class _Statement:
+    # Like aiosqlite's execute() result: can be awaited or used with `async with`.
+
+    def __init__(self, coro):
+        self._coro = coro
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self):
+        return await self._coro
+
+    async def __aexit__(self, *exc):
+        pass
+
+class _WriteOp:
+    __slots__ = ("sql", "params", "many", "future")
+
+    def __init__(self, sql, params, many, future):
+        self.sql = sql
+        self.params = params
+        self.many = many
+        self.future = future
+
+class _Transaction:
+    __slots__ = ("database", "ops", "after_commit", "closed")
+
+    def __init__(self, database):
+        self.database = database
+        self.ops = asyncio.Queue()
+        self.after_commit = []
+        self.closed = False
+
+class Database:
+    """Drop-in replacement for the aiosqlite connection used by the functions in this module.
+
+    SELECTs run on a pool of read-only WAL connections; every other statement goes to a
+    single writer task that owns the only write connection. Commits queued together (or
+    within `group_commit_ms` of each other) are applied as one COMMIT. Execution time is
+    recorded per query. A unit_of_work() gets the writer to itself inside a savepoint, so its
+    reads see its own uncommitted writes and a block that raises is rolled back alone.
+    """
+
+    def __init__(self, path: str, read_pool_size: int = 4, group_commit_ms: int = 0, busy_timeout: float = 30,
+                 user_cache_size: int = USER_CACHE_SIZE):
+        self.path = path
+        # Profiles are cached per database, so bots hosted in one process never see each other's users.
+        self.user_cache = UserCache(user_cache_size)
+        self.read_pool_size = read_pool_size
+        self.commit_window = group_commit_ms / 1000
+        self.busy_timeout = busy_timeout
+        self.commit_count = 0
+        self.query_stats = {}
+        self._writer = None
+        self._readers = []
+        self._read_pool = asyncio.Queue()
+        self._writes = asyncio.Queue()
+        self._write_task = None
+
+    async def open(self):
+        self._writer = await aiosqlite.connect(self.path, timeout=self.busy_timeout)
+        await self._writer.execute("PRAGMA journal_mode=WAL")
+        await self._writer.execute("PRAGMA synchronous=NORMAL")
+        for _ in range(self.read_pool_size):
+            reader = await aiosqlite.connect(f"file:{self.path}?mode=ro", uri=True, timeout=self.busy_timeout)
+            await reader.execute("PRAGMA query_only=ON")
+            self._readers.append(reader)
+            self._read_pool.put_nowait(reader)
+        self._write_task = asyncio.create_task(self._write_loop())
+        return self
+
+    async def close(self):
+        if self._write_task:
+            await self.commit()
+            self._write_task.cancel()
+        for reader in self._readers:
+            await reader.close()
+        if self._writer:
+            await self._writer.close()
+
+    @property
+    def pending_writes(self) -> int:
+        return self._writes.qsize()
+
+    @property
+    def idle_readers(self) -> int:
+        return self._read_pool.qsize()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def execute(self, sql: str, params=()) -> _Statement:
+        is_read = sql.lstrip()[:6].upper() == "SELECT" and self._readers and not _in_unit_of_work.get()
+        return _Statement(self._read(sql, params) if is_read else self._submit(sql, params, many=False))
+
+    async def executemany(self, sql: str, params_seq):
+        return await self._submit(sql, list(params_seq), many=True)
+
+    async def commit(self):
+        future = asyncio.get_running_loop().create_future()
+        self._writes.put_nowait(_WriteOp(None, None, False, future))
+        await future
+
+    async def _read(self, sql: str, params):
+        reader = await self._read_pool.get()
+        try:
+            return await self._run(reader, sql, params, many=False)
+        finally:
+            self._read_pool.put_nowait(reader)
+
+    async def _submit(self, sql: str, params, many: bool):
+        future = asyncio.get_running_loop().create_future()
+        transaction = self._transaction()
+        queue = transaction.ops if transaction else self._writes
+        queue.put_nowait(_WriteOp(sql, params, many, future))
+        return await future
+
+    def _transaction(self):
+        transaction = _transaction.get()
+        if transaction is not None and transaction.database is self and not transaction.closed:
+            return transaction
+        return None
+
+    def _begin(self) -> _Transaction:
+        transaction = _Transaction(self)
+        self._writes.put_nowait(transaction)
+        return transaction
+
+    async def _end(self, transaction: _Transaction, rollback: bool):
+        transaction.closed = True
+        future = asyncio.get_running_loop().create_future()
+        transaction.ops.put_nowait(_WriteOp(None, rollback, False, future))
+        await future
+
+    async def _run(self, connection: aiosqlite.Connection, sql: str, params, many: bool) -> _BufferedCursor:
+        started = time.perf_counter()
+        try:
+            if many:
+                cursor = await connection.executemany(sql, params)
+            else:
+                cursor = await connection.execute(sql, params)
+            rows = await cursor.fetchall()
+            result = _BufferedCursor(rows, cursor.lastrowid, cursor.rowcount)
+            await cursor.close()
+            return result
+        finally:
+            self._record(sql, time.perf_counter() - started)
+
+    def _record(self, sql: str, elapsed: float):
+        key = " ".join(sql.split())
+        stats = self.query_stats.get(key)
+        if stats is None:
+            stats = self.query_stats[key] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        DB_QUERY_SECONDS.observe(elapsed, key[:80])
+
+    def _drain(self, batch: list):
+        while not self._writes.empty():
+            batch.append(self._writes.get_nowait())
+
+    async def _write_loop(self):
+        while True:
+            batch = [await self._writes.get()]
+            self._drain(batch)
+            if self.commit_window and any(isinstance(op, _WriteOp) and op.sql is None for op in batch):
+                await asyncio.sleep(self.commit_window)
+                self._drain(batch)
+
+            commit_waiters = []
+            for op in batch:
+                if isinstance(op, _Transaction):
+                    await self._run_transaction(op)
+                elif op.sql is None:
+                    commit_waiters.append(op.future)
+                else:
+                    await self._apply(op)
+
+            if commit_waiters:
+                try:
+                    started = time.perf_counter()
+                    await self._writer.commit()
+                    self.commit_count += 1
+                    DB_COMMITS.inc()
+                    self._record("COMMIT", time.perf_counter() - started)
+                    error = None
+                except Exception as e:
+                    error = e
+                for future in commit_waiters:
+                    if future.done():
+                        continue
+                    if error:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(None)
+
+    async def _apply(self, op: _WriteOp):
+        try:
+            result = await self._run(self._writer, op.sql, op.params, op.many)
+            if not op.future.done():
+                op.future.set_result(result)
+        except Exception as e:
+            if not op.future.done():
+                op.future.set_exception(e)
+
+    async def _run_transaction(self, transaction: _Transaction):
+        # Until the unit of work ends, only its statements run; everything else waits in the queue.
+        error = None
+        try:
+            if not self._writer.in_transaction:
+                await self._writer.execute("BEGIN")
+            await self._writer.execute("SAVEPOINT unit_of_work")
+        except Exception as e:
+            error = e
+        while True:
+            op = await transaction.ops.get()
+            if op.sql is None:
+                break
+            if error:
+                if not op.future.done():
+                    op.future.set_exception(error)
+            else:
+                await self._apply(op)
+        if error is None:
+            try:
+                if op.params:
+                    await self._writer.execute("ROLLBACK TO unit_of_work")
+                await self._writer.execute("RELEASE unit_of_work")
+            except Exception as e:
+                error = e
+        # The task waiting in _end() may have been cancelled meanwhile.
+        if op.future.done():
+            return
+        if error:
+            op.future.set_exception(error)
+        else:
+            op.future.set_result(None)
+
+async def _commit(db: Database):
+    if _in_unit_of_work.get():
+        return
+    await db.commit()
+
+def after_commit(db: Database, callback):
+    # Runs callback once the current unit of work is committed (never, if it is rolled back); immediately outside one.
+    transaction = db._transaction()
+    if transaction is None:
+        callback()
+    else:
+        transaction.after_commit.append(callback)
+
+@asynccontextmanager
+async def unit_of_work(db: Database):
+    # Applies every db.py write made inside the block in one commit, or none of them if it raises.
+    # Other writers wait while the block runs, so it should only do database work.
+    if _in_unit_of_work.get():
+        yield db
+        return
+    transaction = db._begin()
+    token = _in_unit_of_work.set(True)
+    transaction_token = _transaction.set(transaction)
+    try:
+        yield db
+    except BaseException:
+        await db._end(transaction, rollback=True)
+        # Cached profiles may hold values from the rolled back writes.
+        db.user_cache.clear()
+        raise
+    finally:
+        _transaction.reset(transaction_token)
+        _in_unit_of_work.reset(token)
+    await db._end(transaction, rollback=False)
+    await db.commit()
+    for callback in transaction.after_commit:
+        callback()
+
+async def _create_base_tables(db: Database):
     await db.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -31,64 +414,545 @@ async def create_all_tables(db: aiosqlite.Connection):
         )
     ''')
     await db.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('next_consultant_index', 0)")
-    await db.commit()
 
-async def ensure_consultants_in_db(db: aiosqlite.Connection):
-    for cid in CONSULTANT_IDS:
-        await db.execute("INSERT OR IGNORE INTO consultant_stats (consultant_id) VALUES (?)", (cid,))
-    await db.commit()
+async def _create_question_ledger(db: Database):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS questions (
+            question_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            consultant_id INTEGER NOT NULL,
+            message_id INTEGER,
+            question_text TEXT,
+            asked_at INTEGER NOT NULL,
+            answered_at INTEGER,
+            status TEXT NOT NULL DEFAULT 'open'
+        )
+    ''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_questions_consultant_message ON questions (consultant_id, message_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_questions_status ON questions (status, consultant_id)")
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner INTEGER NOT NULL DEFAULT 0,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            priority INTEGER NOT NULL,
+            question_id INTEGER,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+
+async def _create_broadcasts(db: Database):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            progress_chat_id INTEGER,
+            progress_message_id INTEGER,
+            started_at INTEGER NOT NULL,
+            finished_at INTEGER
+        )
+    ''')
+    await _add_blocked_column(db)
+
+async def _create_secondary_indexes(db: Database):
+    # Users of a consultant (reassignment, per-consultant lookups).
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_assigned_consultant ON users (assigned_consultant_id)")
+    # Each worker restores its own outbox rows.
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_owner ON outbox (owner, outbox_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)")
+
+async def _add_quota_columns(db: Database):
+    async with db.execute("PRAGMA table_info(users)") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if "quota_period_start" in columns:
+        return
+    await db.execute("ALTER TABLE users ADD COLUMN quota_period_start INTEGER DEFAULT 0")
+    await db.execute("ALTER TABLE users ADD COLUMN quota_limit INTEGER")
+    # Carry this month's usage over from the old month-number column.
+    now = datetime.datetime.now()
+    month_start = int(now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp())
+    await db.execute("UPDATE users SET quota_period_start = ? WHERE last_message_month = ?", (month_start, now.month))
 
-async def get_or_create_user(db: aiosqlite.Connection, user_id: int):
-    query = "SELECT full_name, phone_number, city, message_count, last_message_month, assigned_consultant_id FROM users WHERE user_id = ?"
+async def _add_sla_columns(db: Database):
+    async with db.execute("PRAGMA table_info(questions)") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if "assigned_at" in columns:
+        return
+    await db.execute("ALTER TABLE questions ADD COLUMN assigned_at INTEGER")
+    await db.execute("ALTER TABLE questions ADD COLUMN reminded INTEGER NOT NULL DEFAULT 0")
+    await db.execute("ALTER TABLE questions ADD COLUMN escalations INTEGER NOT NULL DEFAULT 0")
+    await db.execute("UPDATE questions SET assigned_at = asked_at")
+
+async def _add_blocked_column(db: Database):
+    async with db.execute("PRAGMA table_info(users)") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if "is_blocked" not in columns:
+        await db.execute("ALTER TABLE users ADD COLUMN is_blocked INTEGER NOT NULL DEFAULT 0")
+
+async def _create_daily_stats(db: Database):
+    # Per consultant per day rollup, updated together with the question it counts; reports only read this table.
+    async with db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'consultant_daily_stats'") as cursor:
+        exists = await cursor.fetchone()
+    if exists:
+        return
+    latency_columns = ",\n".join(f"            {column} INTEGER NOT NULL DEFAULT 0" for column in LATENCY_COLUMNS)
+    await db.execute(f'''
+        CREATE TABLE consultant_daily_stats (
+            day TEXT NOT NULL,
+            consultant_id INTEGER NOT NULL,
+            assigned INTEGER NOT NULL DEFAULT 0,
+            answered INTEGER NOT NULL DEFAULT 0,
+            response_seconds INTEGER NOT NULL DEFAULT 0,
+{latency_columns},
+            PRIMARY KEY (day, consultant_id)
+        ) WITHOUT ROWID
+    ''')
+    # Backfill once from the questions recorded so far.
+    await db.execute(
+        "INSERT INTO consultant_daily_stats (day, consultant_id, assigned) "
+        "SELECT date(asked_at, 'unixepoch', 'localtime'), consultant_id, COUNT(*) FROM questions GROUP BY 1, 2"
+    )
+    # Same buckets as latency_column: (low, high], with no lower bound on the first so 0-second answers count.
+    bounds = (None, *RESPONSE_TIME_BUCKETS, None)
+    bucket_sums = ", ".join(
+        "SUM(" + " AND ".join(
+            ([f"answered_at - asked_at > {low}"] if low is not None else [])
+            + ([f"answered_at - asked_at <= {high}"] if high is not None else [])
+        ) + ")"
+        for low, high in zip(bounds, bounds[1:])
+    )
+    await db.execute(
+        f"INSERT INTO consultant_daily_stats (day, consultant_id, answered, response_seconds, {', '.join(LATENCY_COLUMNS)}) "
+        f"SELECT date(answered_at, 'unixepoch', 'localtime'), consultant_id, COUNT(*), SUM(answered_at - asked_at), {bucket_sums} "
+        f"FROM questions WHERE status = 'answered' GROUP BY 1, 2 "
+        f"ON CONFLICT (day, consultant_id) DO UPDATE SET answered = excluded.answered, "
+        f"response_seconds = excluded.response_seconds, "
+        + ", ".join(f"{column} = excluded.{column}" for column in LATENCY_COLUMNS)
+    )
+
+async def _add_consultant_active_column(db: Database):
+    # Consultants can now be changed at runtime; rows of removed consultants stay for their stats.
+    await db.execute("ALTER TABLE consultant_stats ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+    # Forces the next ensure_consultants_in_db to deactivate consultants no longer configured.
+    await db.execute("DELETE FROM settings WHERE key = 'consultants_fingerprint'")
+
+async def _create_question_messages(db: Database):
+    # Every copy of a question sent to a consultant, so a reply to an older copy still finds the question after a reassignment.
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS question_messages (
+            consultant_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            question_id INTEGER NOT NULL,
+            PRIMARY KEY (consultant_id, message_id)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute(
+        "INSERT OR IGNORE INTO question_messages (consultant_id, message_id, question_id) "
+        "SELECT consultant_id, message_id, question_id FROM questions WHERE message_id IS NOT NULL"
+    )
+
+async def _create_question_user_index(db: Database):
+    # The rolling quota window counts a user's recent questions.
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_questions_user_asked ON questions (user_id, asked_at)")
+
+# Append only: a database at PRAGMA user_version N has run the first N entries. Databases created
+# before versioning start at 0, so the early steps tolerate tables and columns that already exist.
+MIGRATIONS = (
+    _create_base_tables,
+    _add_quota_columns,
+    _create_question_ledger,
+    _add_sla_columns,
+    _create_broadcasts,
+    _create_daily_stats,
+    _create_secondary_indexes,
+    _add_consultant_active_column,
+    _create_question_messages,
+    _create_question_user_index,
+)
+
+async def migrate(db: Database) -> int:
+    # Applies pending migrations, each with its version bump in one transaction; returns how many ran.
+    async with db.execute("PRAGMA user_version") as cursor:
+        version = (await cursor.fetchone())[0]
+    token = _in_unit_of_work.set(True)
+    try:
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            await db.commit()
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                await migration(db)
+                await db.execute(f"PRAGMA user_version = {number}")
+                await db.commit()
+            except Exception:
+                await db.execute("ROLLBACK")
+                raise
+            logging.info(f"Applied database migration {number}: {migration.__name__}")
+    finally:
+        _in_unit_of_work.reset(token)
+    return max(len(MIGRATIONS) - version, 0)
+
+def fingerprint(*values) -> int:
+    # Stable 60-bit digest that fits the INTEGER column of the settings table.
+    return int(hashlib.sha256(repr(values).encode()).hexdigest()[:15], 16)
+
+async def get_setting(db: Database, key: str):
+    async with db.execute("SELECT value FROM settings WHERE key = ?", (key,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else None
+
+async def set_setting(db: Database, key: str, value: int):
+    await db.execute("INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                     (key, value))
+    await _commit(db)
+
+async def ensure_consultants_in_db(db: Database, consultant_ids) -> bool:
+    # Applies the configured consultant list; returns False without writing anything when it is unchanged since the last start.
+    consultants_fingerprint = fingerprint(sorted(consultant_ids))
+    if await get_setting(db, "consultants_fingerprint") == consultants_fingerprint:
+        return False
+    async with unit_of_work(db):
+        await replace_consultants(db, consultant_ids)
+        await set_setting(db, "consultants_fingerprint", consultants_fingerprint)
+    return True
+
+async def replace_consultants(db: Database, consultant_ids):
+    # Bulk upsert in one transaction; bumps consultants_version so other processes reload their list.
+    async with unit_of_work(db):
+        await db.executemany(
+            "INSERT INTO consultant_stats (consultant_id, active) VALUES (?, 1) ON CONFLICT (consultant_id) DO UPDATE SET active = 1",
+            [(cid,) for cid in consultant_ids]
+        )
+        await db.execute("UPDATE consultant_stats SET active = 0 WHERE consultant_id NOT IN (SELECT value FROM json_each(?))",
+                         (json.dumps(list(consultant_ids)),))
+        await db.execute("INSERT INTO settings (key, value) VALUES ('consultants_version', 1) "
+                         "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+
+async def get_active_consultants(db: Database):
+    async with db.execute("SELECT consultant_id FROM consultant_stats WHERE active = 1 ORDER BY consultant_id") as cursor:
+        return [row[0] for row in await cursor.fetchall()]
+
+async def get_or_create_user(db: Database, user_id: int):
+    cached = db.user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    query = ("SELECT full_name, phone_number, city, message_count, quota_period_start, assigned_consultant_id, quota_limit, "
+             "is_blocked FROM users WHERE user_id = ?")
     async with db.execute(query, (user_id,)) as cursor:
         user_data = await cursor.fetchone()
     if user_data is None:
-        await db.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
-        await db.commit()
-        return (None, None, None, 0, 0, None)
+        await db.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        await _commit(db)
+        user_data = (None, None, None, 0, 0, None, None, 0)
+    db.user_cache.set(user_id, user_data)
     return user_data
 
-async def update_user_details(db: aiosqlite.Connection, user_id: int, full_name: str, phone_number: str, city: str):
+async def update_user_details(db: Database, user_id: int, full_name: str, phone_number: str, city: str):
     await db.execute("UPDATE users SET full_name=?, phone_number=?, city=? WHERE user_id=?", (full_name, phone_number, city, user_id))
-    await db.commit()
+    db.user_cache.patch(user_id, full_name=full_name, phone_number=phone_number, city=city)
+    await _commit(db)
+
+async def set_user_blocked(db: Database, user_id: int, blocked: bool):
+    await db.execute("UPDATE users SET is_blocked = ? WHERE user_id = ? AND is_blocked != ?",
+                     (int(blocked), user_id, int(blocked)))
+    db.user_cache.patch(user_id, is_blocked=int(blocked))
+    await _commit(db)
 
-async def assign_consultant_to_user(db: aiosqlite.Connection, user_id: int, consultant_id: int):
+async def assign_consultant_to_user(db: Database, user_id: int, consultant_id: int):
     await db.execute("UPDATE users SET assigned_consultant_id = ? WHERE user_id = ?", (consultant_id, user_id))
-    await db.commit()
+    db.user_cache.patch(user_id, assigned_consultant_id=consultant_id)
+    await _commit(db)
 
-async def update_consultant_info(db: aiosqlite.Connection, consultant_id: int, name: str, username: str):
+async def update_consultant_info(db: Database, consultant_id: int, name: str, username: str):
     await db.execute(
         "UPDATE consultant_stats SET consultant_name = ?, consultant_username = ? WHERE consultant_id = ?",
         (name, username, consultant_id)
     )
-    await db.commit()
+    await _commit(db)
 
-async def increment_message_count(db: aiosqlite.Connection, user_id: int, current_month: int):
-    await db.execute("UPDATE users SET message_count = message_count + 1, last_message_month = ? WHERE user_id = ?", (current_month, user_id))
-    await db.commit()
+async def consume_quota(db: Database, user_id: int, period_boundary: int, new_period_start: int, default_limit: int):
+    # Checks and uses one question of the user's quota in a single statement, so a double-submitted
+    # question can't get past the limit. A stored period
+    # starting before `period_boundary` has expired and restarts at `new_period_start`.
+    # Returns (message_count, quota_limit) after consuming, or None if the quota is used up.
+    async with db.execute(
+        """
+        UPDATE users SET
+            message_count = CASE WHEN quota_period_start < :boundary THEN 1 ELSE message_count + 1 END,
+            quota_period_start = CASE WHEN quota_period_start < :boundary THEN :new_start ELSE quota_period_start END
+        WHERE user_id = :user_id
+          AND (CASE WHEN quota_period_start < :boundary THEN 0 ELSE message_count END) < COALESCE(quota_limit, :limit)
+        RETURNING message_count, quota_period_start, COALESCE(quota_limit, :limit)
+        """,
+        {"boundary": period_boundary, "new_start": new_period_start, "user_id": user_id, "limit": default_limit}
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        db.user_cache.invalidate(user_id)
+        return None
+    db.user_cache.patch(user_id, message_count=row[0], quota_period_start=row[1])
+    await _commit(db)
+    return row[0], row[2]
 
-async def reset_monthly_limit(db: aiosqlite.Connection, user_id: int, current_month: int):
-    await db.execute("UPDATE users SET message_count = 1, last_message_month = ? WHERE user_id = ?", (current_month, user_id))
-    await db.commit()
+async def consume_rolling_quota(db: Database, user_id: int, since: int, now: int, default_limit: int):
+    # Sliding window: the user's questions asked after `since` are counted in the statement that uses one.
+    # The question itself is inserted later in the same unit of work, which keeps the writer to itself meanwhile.
+    # Returns (questions in the window including this one, quota_limit), or None if the quota is used up.
+    async with db.execute(
+        """
+        UPDATE users SET
+            message_count = (SELECT COUNT(*) FROM questions WHERE user_id = :user_id AND asked_at > :since) + 1,
+            quota_period_start = :now
+        WHERE user_id = :user_id
+          AND (SELECT COUNT(*) FROM questions WHERE user_id = :user_id AND asked_at > :since) < COALESCE(quota_limit, :limit)
+        RETURNING message_count, quota_period_start, COALESCE(quota_limit, :limit)
+        """,
+        {"since": since, "now": now, "user_id": user_id, "limit": default_limit}
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        db.user_cache.invalidate(user_id)
+        return None
+    db.user_cache.patch(user_id, message_count=row[0], quota_period_start=row[1])
+    await _commit(db)
+    return row[0], row[2]
+
+async def count_questions_since(db: Database, user_id: int, since: int) -> int:
+    async with db.execute("SELECT COUNT(*) FROM questions WHERE user_id = ? AND asked_at > ?", (user_id, since)) as cursor:
+        return (await cursor.fetchone())[0]
 
-async def get_next_consultant_index(db: aiosqlite.Connection) -> int:
-    async with db.execute("SELECT value FROM settings WHERE key = 'next_consultant_index'") as cursor:
+async def set_user_quota_limit(db: Database, user_id: int, quota_limit) -> bool:
+    # quota_limit=None falls back to the policy's default limit. Returns False for an unknown user.
+    cursor = await db.execute("UPDATE users SET quota_limit = ? WHERE user_id = ?", (quota_limit, user_id))
+    db.user_cache.patch(user_id, quota_limit=quota_limit)
+    await _commit(db)
+    return cursor.rowcount > 0
+
+async def claim_next_consultant_index(db: Database, consultant_count: int) -> int:
+    # Reads and advances the round-robin pointer in one statement, so concurrent claims never collide.
+    async with db.execute(
+        "UPDATE settings SET value = (value + 1) % ? WHERE key = 'next_consultant_index' RETURNING value",
+        (consultant_count,)
+    ) as cursor:
         row = await cursor.fetchone()
-        return row[0] if row else 0
+    await _commit(db)
+    return (row[0] - 1) % consultant_count if row else 0
 
-async def update_next_consultant_index(db: aiosqlite.Connection, new_index: int):
-    await db.execute("UPDATE settings SET value = ? WHERE key = 'next_consultant_index'", (new_index,))
-    await db.commit()
+async def get_open_question_counts(db: Database) -> dict:
+    query = "SELECT consultant_id, COUNT(*) FROM questions WHERE status = 'open' GROUP BY consultant_id"
+    async with db.execute(query) as cursor:
+        return {cid: count for cid, count in await cursor.fetchall()}
 
-async def increment_assigned_count(db: aiosqlite.Connection, consultant_id: int):
+async def increment_assigned_count(db: Database, consultant_id: int):
     await db.execute("UPDATE consultant_stats SET assigned_questions = assigned_questions + 1 WHERE consultant_id = ?", (consultant_id,))
-    await db.commit()
+    await db.execute(
+        "INSERT INTO consultant_daily_stats (day, consultant_id, assigned) VALUES (?, ?, 1) "
+        "ON CONFLICT (day, consultant_id) DO UPDATE SET assigned = assigned + 1",
+        (datetime.date.today().isoformat(), consultant_id)
+    )
+    await _commit(db)
 
-async def increment_answered_count(db: aiosqlite.Connection, consultant_id: int):
+async def increment_answered_count(db: Database, consultant_id: int, response_seconds: int = None):
+    # response_seconds is None for answers that can't be matched to a question; they are counted without a time.
     await db.execute("UPDATE consultant_stats SET answered_questions = answered_questions + 1 WHERE consultant_id = ?", (consultant_id,))
-    await db.commit()
+    if response_seconds is None:
+        await db.execute(
+            "INSERT INTO consultant_daily_stats (day, consultant_id, answered) VALUES (?, ?, 1) "
+            "ON CONFLICT (day, consultant_id) DO UPDATE SET answered = answered + 1",
+            (datetime.date.today().isoformat(), consultant_id)
+        )
+    else:
+        column = latency_column(response_seconds)
+        await db.execute(
+            f"INSERT INTO consultant_daily_stats (day, consultant_id, answered, response_seconds, {column}) VALUES (?, ?, 1, ?, 1) "
+            f"ON CONFLICT (day, consultant_id) DO UPDATE SET answered = answered + 1, "
+            f"response_seconds = response_seconds + excluded.response_seconds, {column} = {column} + 1",
+            (datetime.date.today().isoformat(), consultant_id, response_seconds)
+        )
+    await _commit(db)
+
+async def get_consultant_report(db: Database, first_day: str = None, last_day: str = None):
+    # One row per consultant: lifetime counters, then the rollup totals for the period (all days if no period).
+    latency_sums = ", ".join(f"COALESCE(SUM(d.{column}), 0)" for column in LATENCY_COLUMNS)
+    query = (
+        "SELECT c.consultant_id, c.consultant_name, c.consultant_username, c.assigned_questions, c.answered_questions, "
+        f"COALESCE(SUM(d.assigned), 0), COALESCE(SUM(d.answered), 0), COALESCE(SUM(d.response_seconds), 0), {latency_sums} "
+        "FROM consultant_stats c LEFT JOIN consultant_daily_stats d ON d.consultant_id = c.consultant_id "
+        "AND d.day BETWEEN ? AND ? GROUP BY c.consultant_id ORDER BY c.consultant_id"
+    )
+    async with db.execute(query, (first_day or "0000-00-00", last_day or "9999-12-31")) as cursor:
+        return await cursor.fetchall()
+
+async def iter_daily_stats(db: Database, first_day: str = None, last_day: str = None, page_size: int = 1000):
+    # Streams rollup rows in (day, consultant_id) order, one keyset page at a time.
+    query = (
+        "SELECT d.day, d.consultant_id, c.consultant_name, c.consultant_username, d.assigned, d.answered, "
+        f"d.response_seconds, {', '.join('d.' + column for column in LATENCY_COLUMNS)} "
+        "FROM consultant_daily_stats d LEFT JOIN consultant_stats c ON c.consultant_id = d.consultant_id "
+        "WHERE d.day BETWEEN ? AND ? AND (d.day, d.consultant_id) > (?, ?) ORDER BY d.day, d.consultant_id LIMIT ?"
+    )
+    after = ("", 0)
+    while True:
+        async with db.execute(query, (first_day or "0000-00-00", last_day or "9999-12-31", *after, page_size)) as cursor:
+            rows = await cursor.fetchall()
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        after = (rows[-1][0], rows[-1][1])
+
+async def create_question(db: Database, user_id: int, consultant_id: int, message_id: int, question_text: str,
+                          asked_at: int = None) -> int:
+    # The caller passes asked_at when it also hands the question to the SLA scheduler, whose timer must match assigned_at.
+    now = int(time.time()) if asked_at is None else asked_at
+    cursor = await db.execute(
+        "INSERT INTO questions (user_id, consultant_id, message_id, question_text, asked_at, assigned_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, consultant_id, message_id, question_text, now, now)
+    )
+    await _commit(db)
+    return cursor.lastrowid
+
+async def get_question_by_message(db: Database, consultant_id: int, message_id: int):
+    query = ("SELECT q.question_id, q.user_id, q.status FROM question_messages m "
+             "JOIN questions q ON q.question_id = m.question_id WHERE m.consultant_id = ? AND m.message_id = ?")
+    async with db.execute(query, (consultant_id, message_id)) as cursor:
+        return await cursor.fetchone()
+
+async def get_open_question_of_user(db: Database, user_id: int, consultant_id: int):
+    query = ("SELECT question_id, user_id, status FROM questions WHERE status = 'open' AND consultant_id = ? AND user_id = ? "
+             "ORDER BY question_id DESC LIMIT 1")
+    async with db.execute(query, (consultant_id, user_id)) as cursor:
+        return await cursor.fetchone()
+
+async def predates_ledger(db: Database, sent_at: float) -> bool:
+    # True for messages sent before the first recorded question, which can't be found through question_messages.
+    async with db.execute("SELECT MIN(asked_at) FROM questions") as cursor:
+        started_at = (await cursor.fetchone())[0]
+    return started_at is None or sent_at < started_at
+
+async def mark_question_answered(db: Database, question_id: int):
+    # Returns (answer latency in seconds, consultant the question is assigned to), or None if it was already answered.
+    async with db.execute(
+        "UPDATE questions SET status = 'answered', answered_at = ? WHERE question_id = ? AND status = 'open' "
+        "RETURNING answered_at - asked_at, consultant_id",
+        (int(time.time()), question_id)
+    ) as cursor:
+        row = await cursor.fetchone()
+    await _commit(db)
+    return row
+
+async def set_question_message_id(db: Database, question_id: int, consultant_id: int, message_id: int):
+    await db.execute("UPDATE questions SET message_id = ? WHERE question_id = ?", (message_id, question_id))
+    await db.execute("INSERT OR REPLACE INTO question_messages (consultant_id, message_id, question_id) VALUES (?, ?, ?)",
+                     (consultant_id, message_id, question_id))
+    await _commit(db)
+
+async def mark_question_failed(db: Database, question_id: int):
+    await db.execute("UPDATE questions SET status = 'failed' WHERE question_id = ? AND status = 'open'", (question_id,))
+    await _commit(db)
+
+async def get_pending_sla_questions(db: Database, after_question_id: int = 0):
+    # Open questions (and ones whose delivery failed) are the ones the SLA scheduler watches.
+    query = ("SELECT question_id, consultant_id, assigned_at, reminded FROM questions "
+             "WHERE status IN ('open', 'failed') AND question_id > ? ORDER BY question_id")
+    async with db.execute(query, (after_question_id,)) as cursor:
+        return await cursor.fetchall()
+
+async def get_question_sla_state(db: Database, question_id: int):
+    query = ("SELECT user_id, consultant_id, assigned_at, reminded, status, question_text, escalations "
+             "FROM questions WHERE question_id = ?")
+    async with db.execute(query, (question_id,)) as cursor:
+        return await cursor.fetchone()
 
-async def get_all_stats(db: aiosqlite.Connection):
-    query = "SELECT consultant_id, consultant_name, consultant_username, assigned_questions, answered_questions FROM consultant_stats"
+async def mark_question_reminded(db: Database, question_id: int):
+    await db.execute("UPDATE questions SET reminded = 1 WHERE question_id = ?", (question_id,))
+    await _commit(db)
+
+async def reassign_question(db: Database, question_id: int, consultant_id: int, assigned_at: int):
+    await db.execute(
+        "UPDATE questions SET consultant_id = ?, message_id = NULL, assigned_at = ?, reminded = 0, "
+        "escalations = escalations + 1, status = 'open' WHERE question_id = ?",
+        (consultant_id, assigned_at, question_id)
+    )
+    await _commit(db)
+
+async def record_question_escalation(db: Database, question_id: int, assigned_at: int):
+    # Used when there is no other consultant to move the question to; restarts its SLA clock.
+    await db.execute("UPDATE questions SET assigned_at = ?, escalations = escalations + 1 WHERE question_id = ?",
+                     (assigned_at, question_id))
+    await _commit(db)
+
+async def enqueue_outbox_message(db: Database, owner: int, chat_id: int, text: str, reply_markup: str, priority: int, question_id: int) -> int:
+    cursor = await db.execute(
+        "INSERT INTO outbox (owner, chat_id, text, reply_markup, priority, question_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (owner, chat_id, text, reply_markup, priority, question_id, int(time.time()))
+    )
+    await _commit(db)
+    return cursor.lastrowid
+
+async def delete_outbox_message(db: Database, outbox_id: int):
+    await db.execute("DELETE FROM outbox WHERE outbox_id = ?", (outbox_id,))
+    await _commit(db)
+
+async def get_pending_outbox_messages(db: Database, owner: int, worker_count: int = 1):
+    # Worker 0 adopts the rows of owners that no longer run, left behind when the worker count went down.
+    if owner == 0:
+        await db.execute("UPDATE outbox SET owner = 0 WHERE owner >= ?", (worker_count,))
+        await _commit(db)
+    query = "SELECT outbox_id, chat_id, text, reply_markup, priority, question_id FROM outbox WHERE owner = ? ORDER BY outbox_id"
+    async with db.execute(query, (owner,)) as cursor:
+        return await cursor.fetchall()
+
+async def count_broadcast_recipients(db: Database) -> int:
+    async with db.execute("SELECT COUNT(*) FROM users WHERE is_blocked = 0") as cursor:
+        return (await cursor.fetchone())[0]
+
+async def get_broadcast_recipients(db: Database, after_user_id: int, limit: int):
+    # Keyset pagination on the primary key: each page is an index range scan, however far into the table it is.
+    query = "SELECT user_id FROM users WHERE user_id > ? AND is_blocked = 0 ORDER BY user_id LIMIT ?"
+    async with db.execute(query, (after_user_id, limit)) as cursor:
+        return [row[0] for row in await cursor.fetchall()]
+
+async def create_broadcast(db: Database, text: str, total: int, progress_chat_id: int):
+    # Returns None if a broadcast is already running; the check and the insert are one statement,
+    # so two owners (or workers) starting at once can't both create one.
+    cursor = await db.execute(
+        "INSERT INTO broadcasts (text, total, progress_chat_id, started_at) SELECT ?, ?, ?, ? "
+        "WHERE NOT EXISTS (SELECT 1 FROM broadcasts WHERE status = 'running')",
+        (text, total, progress_chat_id, int(time.time()))
+    )
+    await _commit(db)
+    return cursor.lastrowid if cursor.rowcount > 0 else None
+
+async def get_running_broadcast(db: Database):
+    query = ("SELECT broadcast_id, text, last_user_id, total, sent, failed, progress_chat_id, progress_message_id, started_at "
+             "FROM broadcasts WHERE status = 'running' ORDER BY broadcast_id LIMIT 1")
     async with db.execute(query) as cursor:
-        return await cursor.fetchall()
\ No newline at end of file
+        return await cursor.fetchone()
+
+async def set_broadcast_progress_message(db: Database, broadcast_id: int, message_id: int):
+    await db.execute("UPDATE broadcasts SET progress_message_id = ? WHERE broadcast_id = ?", (message_id, broadcast_id))
+    await _commit(db)
+
+async def checkpoint_broadcast(db: Database, broadcast_id: int, last_user_id: int, sent: int, failed: int) -> bool:
+    # Returns False once the broadcast was cancelled, possibly from another worker.
+    cursor = await db.execute(
+        "UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ? WHERE broadcast_id = ? AND status = 'running'",
+        (last_user_id, sent, failed, broadcast_id)
+    )
+    await _commit(db)
+    return cursor.rowcount > 0
+
+async def finish_broadcast(db: Database, broadcast_id: int, status: str) -> bool:
+    cursor = await db.execute(
+        "UPDATE broadcasts SET status = ?, finished_at = ? WHERE broadcast_id = ? AND status = 'running'",
+        (status, int(time.time()), broadcast_id)
+    )
+    await _commit(db)
+    return cursor.rowcount > 0
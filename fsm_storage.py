@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+import aiosqlite
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage persisted to SQLite with a bounded write-through LRU cache in front of it.
+
+    Keys that have no state are cached too, so the per-update get_state() call made by
+    SubscriptionMiddleware is answered from memory for active users. States untouched
+    for `state_ttl` seconds are treated as abandoned and removed.
+    """
+
+    def __init__(self, path: str, cache_size: int = 10000, state_ttl: int = 86400, sweep_interval: int = 600):
+        self.path = path
+        self.cache_size = cache_size
+        self.state_ttl = state_ttl
+        self.sweep_interval = sweep_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._db: Optional[aiosqlite.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        self.commit_count = 0
+        self._cache = OrderedDict()
+        self._sweeper = None
+
+    async def connect(self):
+        self._db = await aiosqlite.connect(self.path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute("PRAGMA synchronous=NORMAL")
+        await self._db.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at INTEGER NOT NULL
+            )
+        ''')
+        await self._db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)")
+        await self._db.commit()
+        if self.state_ttl > 0:
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def _load(self, key: str):
+        entry = self._cache.get(key)
+        if entry is None:
+            self.misses += 1
+            async with self._db.execute("SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,)) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                entry = (None, {}, time.time())
+            else:
+                entry = (row[0], json.loads(row[1]) if row[1] else {}, row[2])
+            self._remember(key, entry)
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+
+        state, data, updated_at = entry
+        if (state is not None or data) and self.state_ttl > 0 and updated_at + self.state_ttl < time.time():
+            await self._save(key, None, {})
+            return None, {}
+        return state, data
+
+    def _remember(self, key: str, entry):
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _save(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        now = time.time()
+        self._remember(key, (state, data, now))
+        if state is None and not data:
+            await self._db.execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+        else:
+            await self._db.execute(
+                "INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at",
+                (key, state, json.dumps(data, ensure_ascii=False), int(now))
+            )
+        await self._db.commit()
+        self.commit_count += 1
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        _, data = await self._load(storage_key)
+        await self._save(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key = self.key_builder.build(key)
+        state, _ = await self._load(storage_key)
+        await self._save(storage_key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self.key_builder.build(key))
+        return dict(data)
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                cutoff = time.time() - self.state_ttl
+                await self._db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (int(cutoff),))
+                await self._db.commit()
+                expired = [key for key, (_, _, updated_at) in self._cache.items() if updated_at < cutoff]
+                for key in expired:
+                    del self._cache[key]
+            except Exception as e:
+                logging.error(f"Error sweeping expired FSM states: {e}")
+
+    async def close(self) -> None:
+        if self._sweeper:
+            self._sweeper.cancel()
+        if self._db:
+            await self._db.close()
@@ -0,0 +1,31 @@
+from aiogram import Router
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message
+from html import escape
+
+from broadcast import BroadcastEngine
+from consultants import IsOwner
+
+router = Router(name="broadcast")
+
+@router.message(Command("broadcast"), IsOwner())
+async def start_broadcast(message: Message, command: CommandObject, broadcaster: BroadcastEngine):
+    # Usage: /broadcast <text>, or reply to a message with /broadcast to send it with its formatting.
+    if message.reply_to_message and message.reply_to_message.text:
+        text = message.reply_to_message.html_text
+    elif command.args:
+        text = escape(command.args)
+    else:
+        await message.answer("فرمت دستور: <code>/broadcast متن پیام</code>\nیا روی یک پیام ریپلای کرده و /broadcast را ارسال کنید.")
+        return
+
+    broadcast_id = await broadcaster.start(text, message.chat.id)
+    if broadcast_id is None:
+        await message.answer("⚠️ یک ارسال همگانی دیگر در حال انجام است. برای لغو آن از /cancelbroadcast استفاده کنید.")
+
+@router.message(Command("cancelbroadcast"), IsOwner())
+async def cancel_broadcast(message: Message, broadcaster: BroadcastEngine):
+    if await broadcaster.cancel():
+        await message.answer("🛑 ارسال همگانی متوقف شد.")
+    else:
+        await message.answer("هیچ ارسال همگانی فعالی وجود ندارد.")
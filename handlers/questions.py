@@ -1,119 +1,138 @@
 from aiogram import Router, F
-from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.fsm.context import FSMContext
 from html import escape
+import csv
 import datetime
-import aiosqlite
+import os
 import re
 import logging
+import tempfile
+import time
 
 from .registration import Consultation, get_ask_new_question_keyboard
-from db import (get_or_create_user, increment_message_count, reset_monthly_limit,
-                get_next_consultant_index, update_next_consultant_index,
-                increment_assigned_count, increment_answered_count, get_all_stats,
-                assign_consultant_to_user, update_consultant_info)
-from config import CONSULTANT_IDS, MESSAGE_LIMIT, LIMIT_REACHED_MESSAGE, OWNER_ID
+from db import (Database, get_or_create_user, set_user_quota_limit,
+                increment_assigned_count, increment_answered_count, get_consultant_report, iter_daily_stats,
+                assign_consultant_to_user, update_consultant_info, unit_of_work,
+                create_question, get_question_by_message, get_open_question_of_user, predates_ledger, mark_question_answered)
+from config import BotConfig
+from consultants import ConsultantRegistry, IsConsultant, IsOwner
+from assignment import AssignmentEngine
+from quota import QuotaPolicy
+from outbox import Outbox, PRIORITY_ANSWER, PRIORITY_QUESTION
+from sla import SLAScheduler
+from analytics import RESPONSE_TIME_BUCKETS, parse_period, percentile, format_duration, chunk_report
 
-router = Router()
+router = Router(name="questions")
 
-async def pre_question_check(db: aiosqlite.Connection, user_id: int):
+def format_question_message(topic: str, user_id: int, full_name: str, phone_number: str, city: str, username: str, text: str) -> str:
+    return (
+        f"📩 <b>درخواست مشاوره جدید ({escape(topic)})</b>\n\n"
+        f"<b>نام:</b> {escape(full_name or '')}\n"
+        f"<b>تماس:</b> {escape(phone_number or '')}\n"
+        f"<b>شهر:</b> {escape(city or '')}\n"
+        f"<b>آیدی کاربر:</b> <code>{user_id}</code>\n"
+        f"<b>یوزرنیم:</b> @{username or 'ندارد'}\n\n"
+        f"<b>سوال:</b>\n{escape(text or '')}"
+    )
+
+async def pre_question_check(db: Database, user_id: int, quota: QuotaPolicy):
     user_data = await get_or_create_user(db, user_id)
     if not user_data[0]:
         return "not_registered", None
     
-    current_month = datetime.datetime.now().month
-    message_count = user_data[3]
-    last_message_month = user_data[4]
-    
-    is_new_month = last_message_month != current_month
-    effective_count = 0 if is_new_month else message_count
-    
-    if effective_count >= MESSAGE_LIMIT:
+    if await quota.remaining(db, user_id, user_data) <= 0:
         return "limit_reached", None
     
     return "ok", user_data
 
 @router.message(Command("ask", "soal"))
-async def command_ask_handler(message: Message, state: FSMContext, db: aiosqlite.Connection):
+async def command_ask_handler(message: Message, state: FSMContext, db: Database, quota: QuotaPolicy,
+                              consultants: ConsultantRegistry, bot_config: BotConfig):
     user_id = message.from_user.id
-    if user_id in CONSULTANT_IDS:
+    if user_id in consultants:
         await message.answer("سلام مشاور گرامی! 👋\n\nبرای پاسخ به سوالات، کافیست روی پیام آن‌ها ریپلای بزنید.")
         return
 
-    status, _ = await pre_question_check(db, user_id)
+    status, _ = await pre_question_check(db, user_id, quota)
     if status == "not_registered":
         await message.answer("شما هنوز ثبت‌نام نکرده‌اید. لطفاً ابتدا از دستور /start استفاده کنید.")
     elif status == "limit_reached":
-        await message.answer(LIMIT_REACHED_MESSAGE)
+        await message.answer(bot_config.limit_reached_message)
     else:
         await message.answer("لطفاً سوال خود را تایپ و ارسال کنید:")
         await state.set_state(Consultation.waiting_for_question)
 
 @router.callback_query(F.data == "ask_new_question")
-async def ask_new_question_callback(callback: CallbackQuery, state: FSMContext, db: aiosqlite.Connection):
+async def ask_new_question_callback(callback: CallbackQuery, state: FSMContext, db: Database, quota: QuotaPolicy,
+                                    bot_config: BotConfig):
     await callback.answer()
-    status, _ = await pre_question_check(db, callback.from_user.id)
+    status, _ = await pre_question_check(db, callback.from_user.id, quota)
     
     if status == "limit_reached":
-        await callback.message.answer(LIMIT_REACHED_MESSAGE)
+        await callback.message.answer(bot_config.limit_reached_message)
     else:
         await callback.message.answer("لطفاً سوال خود را ارسال کنید:")
         await state.set_state(Consultation.waiting_for_question)
 
 @router.message(Consultation.waiting_for_question)
-async def process_question(message: Message, state: FSMContext, db: aiosqlite.Connection):
+async def process_question(message: Message, state: FSMContext, db: Database, assigner: AssignmentEngine,
+                           outbox: Outbox, quota: QuotaPolicy, sla: SLAScheduler, consultants: ConsultantRegistry,
+                           bot_config: BotConfig):
     user_id = message.from_user.id
     try:
-        current_month = datetime.datetime.now().month
-        status, user_data = await pre_question_check(db, user_id)
+        status, user_data = await pre_question_check(db, user_id, quota)
         
         if status == "limit_reached":
-            await message.answer(LIMIT_REACHED_MESSAGE, reply_markup=get_ask_new_question_keyboard())
+            await message.answer(bot_config.limit_reached_message, reply_markup=get_ask_new_question_keyboard())
             return
 
-        full_name, phone_number, city, message_count, last_message_month, assigned_consultant_id = user_data
-        
-        target_consultant_id = assigned_consultant_id
-        if target_consultant_id and target_consultant_id not in CONSULTANT_IDS:
-            await message.answer("توجه: مشاور قبلی شما دیگر در دسترس نیست. شما به یک مشاور جدید متصل شدید.")
-            target_consultant_id = None
-
-        if target_consultant_id is None:
-            current_index = await get_next_consultant_index(db)
-            target_consultant_id = CONSULTANT_IDS[current_index]
-            await assign_consultant_to_user(db, user_id, target_consultant_id)
-            next_index = (current_index + 1) % len(CONSULTANT_IDS)
-            await update_next_consultant_index(db, next_index)
-        
-        final_message = (
-            f"📩 <b>درخواست مشاوره جدید (روانشناسی)</b>\n\n"
-            f"<b>نام:</b> {escape(full_name)}\n"
-            f"<b>تماس:</b> {escape(phone_number)}\n"
-            f"<b>شهر:</b> {escape(city)}\n"
-            f"<b>آیدی کاربر:</b> <code>{user_id}</code>\n"
-            f"<b>یوزرنیم:</b> @{message.from_user.username or 'ندارد'}\n\n"
-            f"<b>سوال:</b>\n{escape(message.text)}"
-        )
-        
-        await message.bot.send_message(target_consultant_id, final_message)
-        await increment_assigned_count(db, target_consultant_id)
+        full_name, phone_number, city, _, _, assigned_consultant_id, _, _ = user_data
+        reserved_consultant_id = None
+        try:
+            target_consultant_id = assigned_consultant_id
+            if target_consultant_id and target_consultant_id not in consultants:
+                await message.answer("توجه: مشاور قبلی شما دیگر در دسترس نیست. شما به یک مشاور جدید متصل شدید.")
+                target_consultant_id = None
+
+            is_new_assignment = target_consultant_id is None
+            if is_new_assignment:
+                target_consultant_id = await assigner.pick(db)
+            else:
+                assigner.reserve(target_consultant_id)
+            reserved_consultant_id = target_consultant_id
+            
+            final_message = format_question_message(bot_config.topic, user_id, full_name, phone_number, city,
+                                                    message.from_user.username, message.text)
+
+            # The quota and all writes of this question, including its outbox entry, go out in a single commit;
+            # if anything fails nothing is used up.
+            asked_at = int(time.time())
+            async with unit_of_work(db):
+                remaining = await quota.consume(db, user_id)
+                if remaining is not None:
+                    if is_new_assignment:
+                        await assign_consultant_to_user(db, user_id, target_consultant_id)
+                    await increment_assigned_count(db, target_consultant_id)
+                    question_id = await create_question(db, user_id, target_consultant_id, None, message.text, asked_at)
+                    await outbox.send(target_consultant_id, final_message, PRIORITY_QUESTION, question_id=question_id)
+            if remaining is None:
+                assigner.release(target_consultant_id)
+                await message.answer(bot_config.limit_reached_message, reply_markup=get_ask_new_question_keyboard())
+                return
+            sla.track(question_id, target_consultant_id, asked_at)
+        except Exception:
+            if reserved_consultant_id is not None:
+                assigner.release(reserved_consultant_id)
+            raise
         
         await message.answer("✅ سوال شما با موفقیت برای مشاور ارسال شد. \n مشاوران ما حداکثر تا 24 ساعت آینده پاسخ شما را ارسال می‌کنند.")
 
-        is_new_month = last_message_month != current_month
-        if is_new_month:
-            await reset_monthly_limit(db, user_id, current_month)
-            new_count = 1
-        else:
-            await increment_message_count(db, user_id, current_month)
-            new_count = message_count + 1
-
-        remaining = MESSAGE_LIMIT - new_count
         if remaining > 0:
-            await message.answer(f"شما می‌توانید {remaining} سوال دیگر در این ماه بپرسید.", reply_markup=get_ask_new_question_keyboard())
+            await message.answer(f"شما می‌توانید {remaining} سوال دیگر {quota.period_text} بپرسید.", reply_markup=get_ask_new_question_keyboard())
         else:
-            await message.answer(LIMIT_REACHED_MESSAGE, reply_markup=get_ask_new_question_keyboard())
+            await message.answer(bot_config.limit_reached_message, reply_markup=get_ask_new_question_keyboard())
             
     except Exception as e:
         logging.error(f"Error in process_question: {e}")
@@ -121,37 +140,155 @@ async def process_question(message: Message, state: FSMContext, db: aiosqlite.Co
     finally:
         await state.clear()
 
-@router.message(F.from_user.id.in_(CONSULTANT_IDS), F.reply_to_message)
-async def handle_consultant_reply(message: Message, db: aiosqlite.Connection):
+@router.message(IsConsultant(), F.reply_to_message)
+async def handle_consultant_reply(message: Message, db: Database, assigner: AssignmentEngine, outbox: Outbox,
+                                  sla: SLAScheduler):
     consultant = message.from_user
-    match = re.search(r"آیدی کاربر: (\d+)", message.reply_to_message.text)
-    if not match:
+    question = await get_question_by_message(db, consultant.id, message.reply_to_message.message_id)
+    match = None if question else re.search(r"آیدی کاربر: (\d+)", message.reply_to_message.text or "")
+    if match:
+        # The reply can arrive before the outbox has recorded the delivered copy; the question is then still open here.
+        question = await get_open_question_of_user(db, int(match.group(1)), consultant.id)
+    if question:
+        question_id, user_id, _ = question
+    elif match and await predates_ledger(db, message.reply_to_message.date.timestamp()):
+        # Questions forwarded before the ledger existed only carry the user id in their text.
+        question_id, user_id = None, int(match.group(1))
+    else:
         await message.reply("⚠️ خطا: نتوانستم آیدی کاربر را در این پیام پیدا کنم.")
         return
-        
-    user_id = int(match.group(1))
+
     try:
-        await update_consultant_info(db, consultant.id, consultant.full_name, consultant.username)
-        await message.bot.send_message(user_id, f"✉️ پاسخ از طرف مشاور:\n\n---\n{message.text}", reply_markup=get_ask_new_question_keyboard())
-        await increment_answered_count(db, consultant.id)
+        # The answer is queued in the same commit that closes the question, so a restart before it is
+        # delivered can't leave the question open; if it can't be delivered at all it still counts as answered.
+        async with unit_of_work(db):
+            await update_consultant_info(db, consultant.id, consultant.full_name, consultant.username)
+            answered = await mark_question_answered(db, question_id) if question_id else None
+            # Follow-up replies to an already answered question are delivered but not counted again.
+            if question_id is None or answered is not None:
+                await increment_answered_count(db, consultant.id, answered[0] if answered else None)
+            delivery = await outbox.send(user_id, f"✉️ پاسخ از طرف مشاور:\n\n---\n{message.text}", PRIORITY_ANSWER,
+                                         reply_markup=get_ask_new_question_keyboard())
+        if answered is not None:
+            # After a reassignment the answer may come from the previous consultant; the current one is freed.
+            assigner.release(answered[1])
+            sla.resolve(question_id)
+        if await delivery is None:
+            await message.reply(f"❌ خطا در ارسال پیام به کاربر (ID: {user_id}).")
+            return
         await message.reply("✅ پاسخ شما با موفقیت برای کاربر ارسال شد.")
     except Exception as e:
         logging.error(f"Failed to send reply to {user_id}: {e}")
         await message.reply(f"❌ خطا در ارسال پیام به کاربر (ID: {user_id}).")
 
-@router.message(Command("stats"), F.from_user.id == OWNER_ID)
-async def show_stats(message: Message, db: aiosqlite.Connection):
-    stats = await get_all_stats(db)
-    report = "📊 <b>گزارش عملکرد مشاوران:</b>\n\n"
+@router.message(Command("stats"), IsOwner())
+async def show_stats(message: Message, command: CommandObject, db: Database):
+    # Usage: /stats [all|today|week|month|YYYY-MM-DD [YYYY-MM-DD]] [csv]
+    args = (command.args or "").split()
+    export_csv = "csv" in args
+    try:
+        period = parse_period([arg for arg in args if arg != "csv"], datetime.date.today())
+    except ValueError:
+        await message.answer(
+            "فرمت دستور: <code>/stats [all|today|week|month|YYYY-MM-DD [YYYY-MM-DD]] [csv]</code>\n"
+            "مثال: <code>/stats month</code> یا <code>/stats 2024-03-01 2024-03-31 csv</code>"
+        )
+        return
+    title, first_day, last_day = period or ("کل دوره", None, None)
+
+    if export_csv:
+        await send_stats_csv(message, db, title, first_day, last_day)
+        return
+
+    stats = await get_consultant_report(db, first_day, last_day)
     if not stats:
-        report = "هنوز آماری برای نمایش وجود ندارد."
-    else:
-        for row in stats:
-            cid, name, username, assigned, answered = row
-            display_name = f"@{username}" if username else escape(name or "نام ثبت نشده")
-            report += (
-                f"👤 <b>{display_name}</b> (ID: <code>{cid}</code>):\n"
-                f"  📥 سوالات دریافت شده: <b>{assigned}</b>\n"
-                f"  📤 پاسخ‌های ارسال شده: <b>{answered}</b>\n\n"
-            )
-    await message.answer(report)
\ No newline at end of file
+        await message.answer("هنوز آماری برای نمایش وجود ندارد.")
+        return
+    blocks = [f"📊 <b>گزارش عملکرد مشاوران ({escape(title)}):</b>\n\n"]
+    for row in stats:
+        cid, name, username, lifetime_assigned, lifetime_answered, assigned, answered, response_seconds = row[:8]
+        latencies = row[8:]
+        # Without a period the lifetime counters also include answers given before questions were recorded.
+        if period is None:
+            assigned, answered = lifetime_assigned, lifetime_answered
+        timed_answers = sum(latencies)
+        display_name = f"@{username}" if username else escape(name or "نام ثبت نشده")
+        blocks.append(
+            f"👤 <b>{display_name}</b> (ID: <code>{cid}</code>):\n"
+            f"  📥 سوالات دریافت شده: <b>{assigned}</b>\n"
+            f"  📤 پاسخ‌های ارسال شده: <b>{answered}</b>\n"
+            f"  ⏱ میانگین زمان پاسخ: {format_duration(response_seconds / timed_answers if timed_answers else None)}\n"
+            f"  📈 میانه / صدک ۹۰: {format_duration(percentile(latencies, 0.5))} / {format_duration(percentile(latencies, 0.9))}\n\n"
+        )
+    cache = db.user_cache.stats()
+    blocks.append(f"\n🗂 کش پروفایل کاربران: {cache['hits']} hit / {cache['misses']} miss ({cache['hit_rate']:.0%})")
+    for chunk in chunk_report(blocks):
+        await message.answer(chunk)
+
+async def send_stats_csv(message: Message, db: Database, title: str, first_day: str, last_day: str):
+    # Rows are written to a temporary file page by page and uploaded from disk, so the export never sits in memory.
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    try:
+        rows = 0
+        with open(fd, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["day", "consultant_id", "consultant_name", "consultant_username", "assigned", "answered",
+                             "avg_response_minutes", "p50_response_minutes", "p90_response_minutes"])
+            async for row in iter_daily_stats(db, first_day, last_day):
+                day, cid, name, username, assigned, answered, response_seconds = row[:7]
+                latencies = row[7:]
+                timed_answers = sum(latencies)
+                writer.writerow([day, cid, name or "", username or "", assigned, answered,
+                                 round(response_seconds / timed_answers / 60, 1) if timed_answers else "",
+                                 _csv_minutes(percentile(latencies, 0.5)), _csv_minutes(percentile(latencies, 0.9))])
+                rows += 1
+        if not rows:
+            await message.answer("برای این بازه آماری ثبت نشده است.")
+            return
+        filename = f"stats_{first_day or 'all'}_{last_day or 'all'}.csv"
+        await message.answer_document(FSInputFile(path, filename=filename),
+                                      caption=f"📊 آمار روزانه مشاوران ({escape(title)}) - {rows} ردیف")
+    finally:
+        os.remove(path)
+
+def _csv_minutes(seconds):
+    if seconds is None:
+        return ""
+    if seconds == float("inf"):
+        return f">{RESPONSE_TIME_BUCKETS[-1] // 60}"
+    return seconds // 60
+
+@router.message(Command("setlimit"), IsOwner())
+async def set_limit(message: Message, db: Database):
+    # Usage: /setlimit <user_id> <limit|default>
+    parts = (message.text or "").split()
+    if len(parts) != 3 or not parts[1].isdigit() or not (parts[2].isdigit() or parts[2] == "default"):
+        await message.answer("فرمت دستور: <code>/setlimit آیدی_کاربر تعداد</code> یا <code>/setlimit آیدی_کاربر default</code>")
+        return
+    user_id = int(parts[1])
+    quota_limit = None if parts[2] == "default" else int(parts[2])
+    if not await set_user_quota_limit(db, user_id, quota_limit):
+        await message.answer(f"⚠️ کاربری با آیدی <code>{user_id}</code> پیدا نشد.")
+        return
+    await message.answer(f"✅ سقف سوالات کاربر <code>{user_id}</code> به‌روزرسانی شد.")
+
+@router.message(Command("consultants"), IsOwner())
+async def manage_consultants(message: Message, command: CommandObject, db: Database, consultants: ConsultantRegistry):
+    # Usage: /consultants [add|remove <user_id>]; takes effect immediately, without a restart.
+    parts = (command.args or "").split()
+    if parts:
+        if len(parts) != 2 or parts[0] not in ("add", "remove") or not parts[1].isdigit():
+            await message.answer("فرمت دستور: <code>/consultants add آیدی_مشاور</code> یا <code>/consultants remove آیدی_مشاور</code>")
+            return
+        consultant_id = int(parts[1])
+        if parts[0] == "add":
+            new_ids = [*consultants, consultant_id]
+        else:
+            new_ids = [cid for cid in consultants if cid != consultant_id]
+            if not new_ids:
+                await message.answer("⚠️ حداقل یک مشاور باید باقی بماند.")
+                return
+        await consultants.replace(db, new_ids)
+
+    listing = "\n".join(f"• <code>{cid}</code>" for cid in consultants)
+    await message.answer(f"👥 <b>مشاوران فعلی:</b>\n{listing}")
@@ -4,13 +4,13 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKe
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from html import escape
-import aiosqlite
-import datetime
 import re
 
-from db import get_or_create_user, update_user_details
-from middlewares import check_subscription, get_join_channels_keyboard
-from config import MESSAGE_LIMIT, LIMIT_REACHED_MESSAGE, CONSULTANT_IDS, OWNER_ID
+from db import Database, get_or_create_user, update_user_details, set_user_blocked
+from middlewares import SubscriptionChecker
+from config import BotConfig
+from consultants import ConsultantRegistry
+from quota import QuotaPolicy
 
 class Consultation(StatesGroup):
     waiting_for_full_name = State()
@@ -18,43 +18,44 @@ class Consultation(StatesGroup):
     waiting_for_city = State()
     waiting_for_question = State()
 
-router = Router()
+router = Router(name="registration")
 
 def get_ask_new_question_keyboard():
     buttons = [[InlineKeyboardButton(text="❓ پرسیدن سوال جدید", callback_data="ask_new_question")]]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 @router.message(CommandStart())
-async def command_start_handler(message: Message, state: FSMContext, db: aiosqlite.Connection):
+async def command_start_handler(message: Message, state: FSMContext, db: Database, quota: QuotaPolicy,
+                                bot_config: BotConfig, consultants: ConsultantRegistry, subscriptions: SubscriptionChecker):
     user_id = message.from_user.id
-    if user_id in CONSULTANT_IDS:
+    if user_id in consultants:
         await message.answer("سلام مشاور گرامی! 👋\n\nبرای پاسخ به سوالات، کافیست روی پیام آن‌ها ریپلای بزنید.")
         return
-    if user_id == OWNER_ID:
-        await message.answer("سلام، شما با عنوان مدیر توسط ربات شناسایی شدید.\nمی‌توانید با دستور /stats گزارش مشاوران را دریافت کنید.")
+    if user_id == bot_config.owner_id:
+        await message.answer("سلام، شما با عنوان مدیر توسط ربات شناسایی شدید.\nمی‌توانید با دستور /stats گزارش مشاوران را دریافت کنید.\nبا دستور /setlimit می‌توانید سقف سوالات یک کاربر را تغییر دهید.\nبا دستور /broadcast می‌توانید برای همه کاربران پیام ارسال کنید.\nبا دستور /consultants می‌توانید فهرست مشاوران را ببینید و تغییر دهید.")
         return
     
-    if not await check_subscription(message.bot, message.from_user.id):
-        await message.answer("⚠️ برای استفاده از ربات، ابتدا باید در کانال‌های زیر عضو شوید:", reply_markup=get_join_channels_keyboard())
+    if not await subscriptions.check(message.bot, message.from_user.id):
+        await message.answer("⚠️ برای استفاده از ربات، ابتدا باید در کانال‌های زیر عضو شوید:", reply_markup=subscriptions.keyboard())
         return
 
     user_data = await get_or_create_user(db, user_id)
+    # A user who blocked the bot and came back receives broadcasts again.
+    if user_data[7]:
+        await set_user_blocked(db, user_id, False)
     if user_data[0]:  # If the user logged in in the past
-        current_month = datetime.datetime.now().month
-        is_new_month = user_data[4] != current_month
-        effective_count = 0 if is_new_month else user_data[3]
-        if effective_count >= MESSAGE_LIMIT:
-            await message.answer(LIMIT_REACHED_MESSAGE)
+        if await quota.remaining(db, user_id, user_data) <= 0:
+            await message.answer(bot_config.limit_reached_message)
             return
         await message.answer(f"سلام {escape(user_data[0])} عزیز، خوش برگشتید! 👋", reply_markup=get_ask_new_question_keyboard())
     else: # If the user is new
-        await message.answer("سلام! به ربات مشاوره روانشناسی خوش آمدید. 👋\n\nلطفاً نام و نام خانوادگی خود را ارسال کنید:")
+        await message.answer(f"{bot_config.welcome_message}\n\nلطفاً نام و نام خانوادگی خود را ارسال کنید:")
         await state.set_state(Consultation.waiting_for_full_name)
 
 @router.callback_query(F.data == "check_join")
-async def check_join_callback(callback: CallbackQuery, state: FSMContext, db: aiosqlite.Connection):
+async def check_join_callback(callback: CallbackQuery, state: FSMContext, db: Database, subscriptions: SubscriptionChecker):
     await callback.answer("در حال بررسی عضویت شما...", show_alert=False)
-    if await check_subscription(callback.bot, callback.from_user.id):
+    if await subscriptions.check(callback.bot, callback.from_user.id):
         await callback.message.delete()
         user_data = await get_or_create_user(db, callback.from_user.id)
         if user_data[0]:
@@ -87,7 +88,7 @@ async def process_phone_number(message: Message, state: FSMContext):
         await message.answer("❌ شماره تلفن وارد شده نامعتبر است.\n\nلطفاً شماره خود را به فرمت صحیح وارد کنید (مثلاً: 09123456789).")
 
 @router.message(Consultation.waiting_for_city)
-async def process_city(message: Message, state: FSMContext, db: aiosqlite.Connection):
+async def process_city(message: Message, state: FSMContext, db: Database):
     if len(message.text) > 2 and len(message.text) < 50:
         await state.update_data(city=message.text)
         data = await state.get_data()
@@ -1,43 +1,257 @@
 import asyncio
+import functools
 import logging
-import aiosqlite
+import multiprocessing
+from contextlib import AsyncExitStack
 
+from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import BotCommand
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-from config import API_TOKEN
-from middlewares import SubscriptionMiddleware
-from handlers import registration, questions
-from db import create_all_tables, ensure_consultants_in_db, DB_FILE
+from config import (BOTS, BotConfig, TELEGRAM_API_URL, DB_GROUP_COMMIT_MS,
+                    RUN_MODE, WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET,
+                    WEBHOOK_WORKERS, FSM_REDIS_URL, FSM_DB_FILE, FSM_CACHE_SIZE, FSM_STATE_TTL,
+                    OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, QUOTA_WINDOW,
+                    QUOTA_ROLLING_DAYS, DB_READ_POOL_SIZE, METRICS_HOST, METRICS_PORT, PROFILER_ENABLED,
+                    THROTTLE_MESSAGE_RATE, THROTTLE_MESSAGE_BURST, THROTTLE_CALLBACK_RATE, THROTTLE_CALLBACK_BURST,
+                    SLA_REMIND_AFTER_HOURS, SLA_REASSIGN_AFTER_HOURS, SLA_SYNC_INTERVAL,
+                    BROADCAST_PAGE_SIZE, BROADCAST_PROGRESS_INTERVAL, CONSULTANTS_REFRESH_INTERVAL)
+from middlewares import SubscriptionMiddleware, ThrottlingMiddleware, BotContextMiddleware, SubscriptionChecker
+from metrics import (UpdateMetricsMiddleware, HandlerMetricsMiddleware, TelegramRequestMetrics,
+                     register_runtime_metrics, start_metrics_server)
+from fsm_storage import SQLiteStorage
+from assignment import AssignmentEngine
+from consultants import ConsultantRegistry
+from outbox import Outbox
+from quota import QuotaPolicy
+from sla import SLAScheduler
+from broadcast import BroadcastEngine
+from handlers import registration, questions, broadcast
+from db import Database, migrate, ensure_consultants_in_db, get_setting, set_setting, fingerprint
 
-async def main():
+def setup_logging():
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
 
-    bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-    
-    async with aiosqlite.connect(DB_FILE) as db:
-        await create_all_tables(db)
-        await ensure_consultants_in_db(db)
+def create_session() -> AiohttpSession:
+    # One HTTP connection pool for every hosted bot; each request carries its bot's token.
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else AiohttpSession()
+    session.middleware(TelegramRequestMetrics())
+    return session
 
-        dp = Dispatcher()
+def create_bot(bot_config: BotConfig, session: AiohttpSession) -> Bot:
+    return Bot(token=bot_config.token, session=session, default=DefaultBotProperties(parse_mode="HTML"))
 
-        dp.update.middleware(SubscriptionMiddleware())
+async def create_fsm_storage():
+    # Shared by all bots: aiogram's storage keys already include the bot id.
+    if FSM_REDIS_URL:
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(FSM_REDIS_URL)
+    # Webhook workers share the SQLite file; a per-process cache would serve stale state.
+    cache_size = FSM_CACHE_SIZE if RUN_MODE != "webhook" or WEBHOOK_WORKERS == 1 else 0
+    storage = SQLiteStorage(FSM_DB_FILE, cache_size=cache_size, state_ttl=FSM_STATE_TTL)
+    await storage.connect()
+    return storage
 
-        dp.include_router(registration.router)
-        dp.include_router(questions.router)
-        
-        commands = [
-            BotCommand(command="start", description="🚀 شروع مجدد و ثبت نام"),
-            BotCommand(command="ask", description="❓ پرسیدن سوال جدید")
-        ]
-        await bot.set_my_commands(commands)
-        
-        print("🤖 Psychology Bot started...")
-        await dp.start_polling(bot, db=db)
+def create_dispatcher(storage, contexts: dict) -> Dispatcher:
+    # `contexts` maps each bot's id to its workflow data (see create_bot_context).
+    dp = Dispatcher(storage=storage)
+
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.update.outer_middleware(BotContextMiddleware(contexts))
+    dp.update.middleware(ThrottlingMiddleware(
+        {"message": (THROTTLE_MESSAGE_RATE, THROTTLE_MESSAGE_BURST),
+         "callback_query": (THROTTLE_CALLBACK_RATE, THROTTLE_CALLBACK_BURST)}
+    ))
+    dp.update.middleware(SubscriptionMiddleware())
+    # Inner middlewares on the dispatcher also wrap the handlers of the included routers.
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+    dp.include_router(registration.router)
+    dp.include_router(questions.router)
+    dp.include_router(broadcast.router)
+    return dp
+
+BOT_COMMANDS = [
+    BotCommand(command="start", description="🚀 شروع مجدد و ثبت نام"),
+    BotCommand(command="ask", description="❓ پرسیدن سوال جدید")
+]
+
+async def prepare_database(bot: Bot, bot_config: BotConfig, webhook_url: str = None):
+    # One-time startup work; in webhook mode it runs once in the parent, not in every worker.
+    # Each step is skipped when nothing changed since the last start, so a plain restart does no DDL or API calls.
+    async with Database(bot_config.db_file, read_pool_size=0) as db:
+        await migrate(db)
+        await ensure_consultants_in_db(db, bot_config.consultant_ids)
+
+        commands_fingerprint = fingerprint(bot.id, [(c.command, c.description) for c in BOT_COMMANDS])
+        if await get_setting(db, "bot_commands_fingerprint") != commands_fingerprint:
+            await bot.set_my_commands(BOT_COMMANDS)
+            await set_setting(db, "bot_commands_fingerprint", commands_fingerprint)
+
+        # Polling needs the webhook removed (a leftover one makes getUpdates fail), webhook mode needs ours set.
+        webhook_fingerprint = fingerprint(bot.id, webhook_url, WEBHOOK_SECRET if webhook_url else None)
+        if await get_setting(db, "webhook_fingerprint") != webhook_fingerprint:
+            if webhook_url:
+                await bot.set_webhook(webhook_url, secret_token=WEBHOOK_SECRET, drop_pending_updates=False)
+            else:
+                await bot.delete_webhook()
+            await set_setting(db, "webhook_fingerprint", webhook_fingerprint)
+
+def open_database(bot_config: BotConfig) -> Database:
+    return Database(bot_config.db_file, read_pool_size=DB_READ_POOL_SIZE, group_commit_ms=DB_GROUP_COMMIT_MS)
+
+async def start_metrics(contexts: dict, storage, worker_index: int = 0):
+    register_runtime_metrics(
+        {context["bot_config"].name: {"db": context["db"], "outbox": context["outbox"],
+                                      "caches": {"user": context["db"].user_cache, "subscription": context["subscriptions"].cache}}
+         for context in contexts.values()},
+        {"fsm": storage}
+    )
+    if METRICS_PORT:
+        return await start_metrics_server(METRICS_HOST, METRICS_PORT + worker_index, PROFILER_ENABLED)
+    return None
+
+async def create_bot_context(bot: Bot, bot_config: BotConfig, db: Database, worker_index: int = 0) -> dict:
+    consultants = ConsultantRegistry(bot_config.consultant_ids)
+    await consultants.load(db)
+    assigner = AssignmentEngine(consultants, bot_config.assignment_strategy, bot_config.consultant_weights)
+    await assigner.load(db)
+
+    # Webhook workers split the bot-wide rate limit between them and can't share an in-process profile cache.
+    workers = WEBHOOK_WORKERS if RUN_MODE == "webhook" else 1
+    if workers > 1:
+        db.user_cache.resize(0)
+        consultants.watch(db, CONSULTANTS_REFRESH_INTERVAL)
+    outbox = Outbox(bot, db, owner=worker_index, global_rate=OUTBOX_GLOBAL_RATE / workers,
+                    chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST, on_question_failed=assigner.release,
+                    worker_count=workers)
+    await outbox.start()
+    quota = QuotaPolicy(bot_config.message_limit, QUOTA_WINDOW, QUOTA_ROLLING_DAYS)
+    # Worker 0 runs the SLA timers for everyone and picks up the other workers' questions from the database.
+    sla = SLAScheduler(db, outbox, assigner, bot_config.owner_id, SLA_REMIND_AFTER_HOURS * 3600, SLA_REASSIGN_AFTER_HOURS * 3600,
+                       functools.partial(questions.format_question_message, bot_config.topic), active=worker_index == 0,
+                       sync_interval=SLA_SYNC_INTERVAL if workers > 1 else 0)
+    await sla.start()
+    broadcaster = BroadcastEngine(bot, db, outbox, BROADCAST_PAGE_SIZE, BROADCAST_PROGRESS_INTERVAL)
+    # A broadcast interrupted by a restart continues from its last checkpoint, in a single worker.
+    if worker_index == 0:
+        await broadcaster.resume()
+    return {"bot_config": bot_config, "consultants": consultants, "subscriptions": SubscriptionChecker(bot_config.channels),
+            "db": db, "assigner": assigner, "outbox": outbox, "quota": quota, "sla": sla, "broadcaster": broadcaster}
+
+async def stop_bot_context(context: dict):
+    await context["broadcaster"].stop()
+    await context["sla"].stop()
+    await context["outbox"].stop()
+    await context["consultants"].stop()
+
+async def start_bots(stack: AsyncExitStack, session: AiohttpSession, worker_index: int = 0):
+    # Opens every configured bot's database and services; they are stopped and closed when `stack` exits.
+    bots, contexts = [], {}
+    for bot_config in BOTS:
+        bot = create_bot(bot_config, session)
+        db = await stack.enter_async_context(open_database(bot_config))
+        context = await create_bot_context(bot, bot_config, db, worker_index)
+        stack.push_async_callback(stop_bot_context, context)
+        bots.append(bot)
+        contexts[bot.id] = context
+    return bots, contexts
+
+async def run_polling():
+    session = create_session()
+    for bot_config in BOTS:
+        await prepare_database(create_bot(bot_config, session), bot_config)
+
+    async with AsyncExitStack() as stack:
+        stack.push_async_callback(session.close)
+        bots, contexts = await start_bots(stack, session)
+        storage = await create_fsm_storage()
+        stack.push_async_callback(storage.close)
+        dp = create_dispatcher(storage, contexts)
+        metrics_runner = await start_metrics(contexts, storage)
+        if metrics_runner:
+            stack.push_async_callback(metrics_runner.cleanup)
+
+        print(f"🤖 Bots started: {', '.join(bot_config.name for bot_config in BOTS)}")
+        await dp.start_polling(*bots)
+
+def webhook_path(bot_config: BotConfig) -> str:
+    # A single bot keeps the plain path, so existing deployments need no change.
+    return WEBHOOK_PATH if len(BOTS) == 1 else f"{WEBHOOK_PATH}/{bot_config.name.lower()}"
+
+async def register_webhook():
+    session = create_session()
+    try:
+        for bot_config in BOTS:
+            await prepare_database(create_bot(bot_config, session), bot_config,
+                                   webhook_url=f"{WEBHOOK_BASE_URL}{webhook_path(bot_config)}")
+    finally:
+        await session.close()
+
+async def run_webhook_worker(worker_index: int):
+    session = create_session()
+    # Each worker owns its database layers; WAL lets them read concurrently and serializes their commits.
+    async with AsyncExitStack() as stack:
+        stack.push_async_callback(session.close)
+        bots, contexts = await start_bots(stack, session, worker_index)
+        storage = await create_fsm_storage()
+        stack.push_async_callback(storage.close)
+        dp = create_dispatcher(storage, contexts)
+        metrics_runner = await start_metrics(contexts, storage, worker_index)
+        if metrics_runner:
+            stack.push_async_callback(metrics_runner.cleanup)
+
+        app = web.Application()
+        for bot in bots:
+            SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(
+                app, path=webhook_path(contexts[bot.id]["bot_config"]))
+        setup_application(app, dp)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        stack.push_async_callback(runner.cleanup)
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WEBHOOK_WORKERS > 1)
+        await site.start()
+        print(f"🤖 Webhook worker {worker_index} listening on {WEBHOOK_HOST}:{WEBHOOK_PORT} "
+              f"for {', '.join(webhook_path(bot_config) for bot_config in BOTS)}")
+        await asyncio.Event().wait()
+
+def webhook_worker_process(worker_index: int):
+    setup_logging()
+    try:
+        asyncio.run(run_webhook_worker(worker_index))
+    except KeyboardInterrupt:
+        pass
+
+def run_webhook():
+    asyncio.run(register_webhook())
+    if WEBHOOK_WORKERS == 1:
+        asyncio.run(run_webhook_worker(0))
+        return
+
+    # Workers share the port through SO_REUSEPORT and the kernel balances connections between them.
+    workers = [multiprocessing.Process(target=webhook_worker_process, args=(i,)) for i in range(WEBHOOK_WORKERS)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
 
 if __name__ == "__main__":
+    setup_logging()
     try:
-        asyncio.run(main())
+        if RUN_MODE == "webhook":
+            run_webhook()
+        else:
+            asyncio.run(run_polling())
     except KeyboardInterrupt:
-        print("Bot stopped by admin.")
\ No newline at end of file
+        print("Bot stopped by admin.")
@@ -0,0 +1,215 @@
+import asyncio
+import bisect
+import logging
+import sys
+import threading
+import time
+from collections import Counter as _StackCounter
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+class Gauge:
+    # Values are read from `callback` at scrape time; it returns {label_values_tuple: value}.
+    # metric_type="counter" exposes monotonic values that are tracked elsewhere (e.g. cache hits).
+    def __init__(self, name: str, documentation: str, labels=(), callback=None, metric_type: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+        self.metric_type = metric_type
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.metric_type}"
+        try:
+            values = self.callback() if self.callback else {}
+        except Exception as e:
+            logging.error(f"Error reading gauge {self.name}: {e}")
+            return
+        for label_values, value in values.items():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        label_names = self.labels + ("le",)
+        for label_values, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(label_names, label_values + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}"
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels=()) -> Counter:
+        return self._add(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, labels=(), callback=None, metric_type: str = "gauge") -> Gauge:
+        return self._add(Gauge(name, documentation, labels, callback, metric_type))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+UPDATE_SECONDS = registry.histogram("bot_update_seconds", "Time spent processing an update, including middlewares.", ("update_type",))
+HANDLER_SECONDS = registry.histogram("bot_handler_seconds", "Time spent in a handler.", ("router", "handler"))
+HANDLER_ERRORS = registry.counter("bot_handler_errors_total", "Exceptions raised by handlers.", ("router", "handler"))
+DB_QUERY_SECONDS = registry.histogram("bot_db_query_seconds", "Execution time of SQLite statements.", ("query",))
+DB_COMMITS = registry.counter("bot_db_commits_total", "SQLite commits.")
+TELEGRAM_REQUEST_SECONDS = registry.histogram("bot_telegram_request_seconds", "Latency of Telegram Bot API calls.", ("method",))
+THROTTLED_UPDATES = registry.counter("bot_throttled_updates_total", "Updates dropped by the per-user throttle.", ("update_type",))
+TELEGRAM_REQUEST_ERRORS = registry.counter("bot_telegram_request_errors_total", "Failed Telegram Bot API calls.", ("method", "error"))
+BROADCAST_MESSAGES = registry.counter("bot_broadcast_messages_total", "Broadcast messages by delivery result.", ("result",))
+
+def register_runtime_metrics(bots: dict, shared_caches: dict):
+    # `bots` maps a bot name to {"db", "outbox", "caches"}; a cache is any object with `hits` and `misses`.
+    registry.gauge("bot_outbox_depth", "Messages waiting in the outbox.", ("bot",),
+                   callback=lambda: {(name,): len(bot["outbox"]) for name, bot in bots.items()})
+    registry.gauge("bot_db_write_queue_depth", "Statements waiting for the SQLite writer.", ("bot",),
+                   callback=lambda: {(name,): bot["db"].pending_writes for name, bot in bots.items()})
+    registry.gauge("bot_db_idle_readers", "Idle connections in the SQLite read pool.", ("bot",),
+                   callback=lambda: {(name,): bot["db"].idle_readers for name, bot in bots.items()})
+
+    def cache_requests():
+        values = {}
+        caches = [(("", name), cache) for name, cache in shared_caches.items()]
+        caches += [((bot_name, name), cache) for bot_name, bot in bots.items() for name, cache in bot["caches"].items()]
+        for labels, cache in caches:
+            if hasattr(cache, "hits"):
+                values[labels + ("hit",)] = cache.hits
+                values[labels + ("miss",)] = cache.misses
+        return values
+
+    registry.gauge("bot_cache_requests_total", "Cache lookups by result.", ("bot", "cache", "result"),
+                   callback=cache_requests, metric_type="counter")
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    # Registered as an outer middleware on dp.update so it also measures the other middlewares.
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started, event.event_type)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Registered on router observers, where the matched handler is known.
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        router = data.get("event_router")
+        labels = (router.name if router else "", handler_object.callback.__name__ if handler_object else "")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(*labels)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, *labels)
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_REQUEST_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, name)
+
+def sample_stacks(thread_id: int, seconds: float, interval: float = 0.005) -> str:
+    # Samples the given thread's stack and returns it in collapsed (flame graph) format.
+    stacks = _StackCounter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+            frame = frame.f_back
+        if names:
+            stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+async def start_metrics_server(host: str, port: int, profiler_enabled: bool = False) -> web.AppRunner:
+    loop_thread_id = threading.get_ident()
+
+    async def metrics_handler(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def profile_handler(request):
+        seconds = min(float(request.query.get("seconds", "10")), 120)
+        result = await asyncio.to_thread(sample_stacks, loop_thread_id, seconds)
+        return web.Response(text=result, content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    if profiler_enabled:
+        app.router.add_get("/debug/profile", profile_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics available on http://{host}:{port}/metrics")
+    return runner
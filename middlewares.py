@@ -1,26 +1,87 @@
+import asyncio
 import logging
+import time
+from collections import OrderedDict
 from aiogram import BaseMiddleware, types, Bot
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-from config import CHANNELS
-
-def get_join_channels_keyboard():
-    buttons = [
-        [InlineKeyboardButton(text=f"📢 عضویت در کانال {i+1}", url=f"https://t.me/{c.lstrip('@')}")]
-        for i, c in enumerate(CHANNELS)
-    ]
-    buttons.append([InlineKeyboardButton(text="✅ عضو شدم", callback_data="check_join")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
-
-async def check_subscription(bot: Bot, user_id: int) -> bool:
-    for channel in CHANNELS:
-        try:
-            member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
-            if member.status not in ['member', 'administrator', 'creator']:
-                return False
-        except Exception as e:
-            logging.error(f"Error checking subscription for {channel}: {e}")
+from outbox import PRIORITY_PROMPT
+from metrics import THROTTLED_UPDATES
+from config import SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_CACHE_NEGATIVE_TTL
+
+class SubscriptionCache:
+    """Bounded LRU of user_id -> (is_subscribed, expires_at)."""
+
+    def __init__(self, max_size: int, positive_ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        is_subscribed, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return is_subscribed
+
+    def set(self, user_id: int, is_subscribed: bool):
+        if self.max_size <= 0:
+            return
+        ttl = self.positive_ttl if is_subscribed else self.negative_ttl
+        self._entries[user_id] = (is_subscribed, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+async def _is_member(bot: Bot, channel: str, user_id: int):
+    # Returns None on API errors so that transient failures are not cached.
+    try:
+        member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
+        return member.status in ['member', 'administrator', 'creator']
+    except Exception as e:
+        logging.error(f"Error checking subscription for {channel}: {e}")
+        return None
+
+class SubscriptionChecker:
+    """Channel membership check of one bot, with its own cache since every bot has its own channels."""
+
+    def __init__(self, channels):
+        self.channels = list(channels)
+        self.cache = SubscriptionCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_CACHE_NEGATIVE_TTL)
+
+    def keyboard(self):
+        buttons = [
+            [InlineKeyboardButton(text=f"📢 عضویت در کانال {i+1}", url=f"https://t.me/{c.lstrip('@')}")]
+            for i, c in enumerate(self.channels)
+        ]
+        buttons.append([InlineKeyboardButton(text="✅ عضو شدم", callback_data="check_join")])
+        return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+    async def check(self, bot: Bot, user_id: int) -> bool:
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        results = await asyncio.gather(*(_is_member(bot, channel, user_id) for channel in self.channels))
+        if False in results:
+            self.cache.set(user_id, False)
             return False
-    return True
+        if None in results:
+            return False
+        self.cache.set(user_id, True)
+        return True
 
 class SubscriptionMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: types.Update, data):
@@ -29,6 +90,7 @@ class SubscriptionMiddleware(BaseMiddleware):
             return await handler(event, data)
             
         state = data.get('state')
+        subscriptions = data['subscriptions']
 
         if await state.get_state() is not None:
             return await handler(event, data)
@@ -36,15 +98,91 @@ class SubscriptionMiddleware(BaseMiddleware):
         if event.message and event.message.text and event.message.text.startswith("/start"):
             return await handler(event, data)
         if event.callback_query and event.callback_query.data == "check_join":
+            # The user claims to have just joined, so the cached answer is stale.
+            subscriptions.cache.invalidate(user.id)
             return await handler(event, data)
 
         bot = data['bot']
-        if not await check_subscription(bot, user.id):
-            await bot.send_message(
+        if not await subscriptions.check(bot, user.id):
+            await data['outbox'].send(
                 user.id,
                 "⚠️ برای ادامه فعالیت در ربات، باید در کانال‌های زیر عضو باشید:",
-                reply_markup=get_join_channels_keyboard()
+                PRIORITY_PROMPT,
+                reply_markup=subscriptions.keyboard(),
+                durable=False
             )
             return
         
-        return await handler(event, data)
\ No newline at end of file
+        return await handler(event, data)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Per-user token buckets that drop floods before they reach the subscription check or the database.
+
+    `limits` maps an update type ("message", "callback_query") to (rate per second, burst).
+    A bucket is a [tokens, last_refill, notified] list keyed by (bot_id, user_id, update_type);
+    refilled buckets are swept away periodically, and at `max_buckets` the least recently
+    updated bucket is evicted, so a flood of new senders costs O(1) per update.
+    Throttled callbacks are answered once per burst so the button stops spinning; the rest,
+    like throttled messages, are dropped without any API call.
+    """
+
+    def __init__(self, limits: dict, max_buckets: int = 100000, sweep_interval: float = 60):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self.sweep_interval = sweep_interval
+        self._buckets = OrderedDict()
+        self._last_sweep = time.monotonic()
+
+    async def __call__(self, handler, event: types.Update, data):
+        user = data.get('event_from_user')
+        limit = self.limits.get(event.event_type)
+        if not user or not limit or user.id == data['bot_config'].owner_id or user.id in data['consultants']:
+            return await handler(event, data)
+
+        rate, burst = limit
+        now = time.monotonic()
+        if now - self._last_sweep >= self.sweep_interval:
+            self._sweep(now)
+
+        key = (data['bot'].id, user.id, event.event_type)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._buckets.popitem(last=False)
+            bucket = self._buckets[key] = [burst, now, False]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return await handler(event, data)
+
+        THROTTLED_UPDATES.inc(event.event_type)
+        if event.callback_query and not bucket[2]:
+            bucket[2] = True
+            await event.callback_query.answer("⏳ لطفاً کمی صبر کنید و دوباره تلاش کنید.")
+        return None
+
+    def _sweep(self, now: float):
+        self._last_sweep = now
+        for key, (tokens, updated, _) in list(self._buckets.items()):
+            rate, burst = self.limits[key[2]]
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[key]
+
+class BotContextMiddleware(BaseMiddleware):
+    """Injects the services of the bot that received the update (database, outbox, consultants, ...).
+
+    All hosted bots share one dispatcher; `contexts` maps a bot id to its workflow data.
+    """
+
+    def __init__(self, contexts: dict):
+        self.contexts = contexts
+
+    async def __call__(self, handler, event: types.Update, data):
+        data.update(self.contexts[data['bot'].id])
+        return await handler(event, data)
@@ -0,0 +1,222 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramForbiddenError
+from aiogram.types import InlineKeyboardMarkup
+
+from db import (after_commit, enqueue_outbox_message, delete_outbox_message, get_pending_outbox_messages,
+                set_question_message_id, mark_question_failed, set_user_blocked)
+
+# Lower values are sent first.
+PRIORITY_ANSWER = 0
+PRIORITY_QUESTION = 1
+PRIORITY_PROMPT = 2
+PRIORITY_BROADCAST = 3
+
+MAX_TRANSIENT_RETRIES = 5
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+class OutboxItem:
+    __slots__ = ("outbox_id", "chat_id", "text", "reply_markup", "priority", "question_id", "future", "attempts", "seq")
+
+    def __init__(self, outbox_id, chat_id, text, reply_markup, priority, question_id, future):
+        self.outbox_id = outbox_id
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.priority = priority
+        self.question_id = question_id
+        self.future = future
+        self.attempts = 0
+        self.seq = None
+
+class Outbox:
+    """Rate-limited, prioritized queue for outgoing messages.
+
+    Durable items are written to the outbox table before they are queued and deleted once
+    Telegram accepted them, so queued questions and answers survive a restart. A global
+    token bucket keeps the bot under Telegram's overall limit and per-chat buckets keep
+    each chat under its flood limit; RetryAfter pauses sending and requeues the item.
+    """
+
+    def __init__(self, bot: Bot, db, owner: int = 0, global_rate: float = 25, chat_rate: float = 1,
+                 chat_burst: int = 3, on_question_failed=None, worker_count: int = 1):
+        self.bot = bot
+        self.db = db
+        self.owner = owner
+        self.worker_count = worker_count
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.on_question_failed = on_question_failed
+        self._chat_buckets = {}
+        self._ready = []
+        self._delayed = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0
+        self._worker = None
+        self._in_flight = set()
+
+    def __len__(self):
+        return len(self._ready) + len(self._delayed)
+
+    async def start(self):
+        for outbox_id, chat_id, text, reply_markup, priority, question_id in await get_pending_outbox_messages(self.db, self.owner, self.worker_count):
+            markup = InlineKeyboardMarkup.model_validate_json(reply_markup) if reply_markup else None
+            self._push(OutboxItem(outbox_id, chat_id, text, markup, priority, question_id, None))
+        if self._ready:
+            logging.info(f"Outbox restored {len(self._ready)} pending messages")
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+        for task in list(self._in_flight):
+            task.cancel()
+
+    async def send(self, chat_id: int, text: str, priority: int = PRIORITY_PROMPT,
+                   reply_markup: InlineKeyboardMarkup = None, durable: bool = True, question_id: int = None):
+        # Returns a future resolving to the sent Message, or None if the message could not be delivered.
+        outbox_id = None
+        if durable:
+            outbox_id = await enqueue_outbox_message(
+                self.db, self.owner, chat_id, text,
+                reply_markup.model_dump_json(exclude_none=True) if reply_markup else None,
+                priority, question_id
+            )
+        future = asyncio.get_running_loop().create_future()
+        item = OutboxItem(outbox_id, chat_id, text, reply_markup, priority, question_id, future)
+        # Inside a unit of work the message is only sent once its row is committed.
+        after_commit(self.db, lambda: self._push(item))
+        return future
+
+    def _push(self, item: OutboxItem):
+        # Requeued items keep their original sequence number so a chat's messages stay in order.
+        if item.seq is None:
+            item.seq = next(self._seq)
+        heapq.heappush(self._ready, (item.priority, item.seq, item))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Drop buckets that have refilled completely; they behave exactly like new ones.
+                now = time.monotonic()
+                for cid, idle in list(self._chat_buckets.items()):
+                    if idle.wait_time(now) == 0 and idle.tokens >= idle.capacity:
+                        del self._chat_buckets[cid]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _next_item(self) -> OutboxItem:
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, item = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (item.priority, item.seq, item))
+
+            if self._ready:
+                _, _, item = heapq.heappop(self._ready)
+                bucket = self._chat_bucket(item.chat_id)
+                wait = bucket.wait_time(now)
+                if wait == 0:
+                    bucket.consume()
+                    return item
+                # This chat is over its limit; let other chats go first.
+                heapq.heappush(self._delayed, (now + wait, item.seq, item))
+                continue
+
+            self._wakeup.clear()
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self):
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            wait = self.global_bucket.wait_time(time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            item = await self._next_item()
+            self.global_bucket.consume()
+            task = asyncio.create_task(self._deliver(item))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _deliver(self, item: OutboxItem):
+        try:
+            message = await self.bot.send_message(item.chat_id, item.text, reply_markup=item.reply_markup)
+        except TelegramRetryAfter as e:
+            logging.warning(f"Flood limit hit while sending to {item.chat_id}, retrying in {e.retry_after}s")
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            self._push(item)
+            return
+        except (TelegramNetworkError, TelegramServerError) as e:
+            item.attempts += 1
+            if item.attempts <= MAX_TRANSIENT_RETRIES:
+                logging.warning(f"Transient error sending to {item.chat_id} (attempt {item.attempts}): {e}")
+                heapq.heappush(self._delayed, (time.monotonic() + 2 ** item.attempts, item.seq, item))
+                self._wakeup.set()
+                return
+            await self._fail(item, e)
+            return
+        except Exception as e:
+            await self._fail(item, e)
+            return
+
+        try:
+            if item.question_id:
+                await set_question_message_id(self.db, item.question_id, item.chat_id, message.message_id)
+            if item.outbox_id:
+                await delete_outbox_message(self.db, item.outbox_id)
+        except Exception as e:
+            logging.error(f"Error recording delivered outbox message {item.outbox_id}: {e}")
+        if item.future and not item.future.done():
+            item.future.set_result(message)
+
+    async def _fail(self, item: OutboxItem, error: Exception):
+        logging.error(f"Failed to send message to {item.chat_id}: {error}")
+        try:
+            if isinstance(error, TelegramForbiddenError):
+                # The user blocked the bot; broadcasts skip them until they /start again.
+                await set_user_blocked(self.db, item.chat_id, True)
+            if item.question_id:
+                await mark_question_failed(self.db, item.question_id)
+                if self.on_question_failed:
+                    self.on_question_failed(item.chat_id)
+            if item.outbox_id:
+                await delete_outbox_message(self.db, item.outbox_id)
+        except Exception as e:
+            logging.error(f"Error recording failed outbox message {item.outbox_id}: {e}")
+        if item.future and not item.future.done():
+            item.future.set_result(None)
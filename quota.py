@@ -0,0 +1,55 @@
+import datetime
+import time
+
+from db import consume_quota, consume_rolling_quota, count_questions_since
+
+QUOTA_WINDOWS = ("calendar_month", "rolling")
+
+class QuotaPolicy:
+    """Question quota per user over a calendar month or a sliding window of the last `rolling_days`.
+
+    The default limit applies unless the user has a quota_limit override. The rolling window
+    counts the user's recorded questions, so consume() has to run in the unit of work that
+    records the question.
+    """
+
+    def __init__(self, default_limit: int, window: str = "calendar_month", rolling_days: int = 30):
+        if window not in QUOTA_WINDOWS:
+            raise ValueError(f"Unknown quota window: {window}")
+        self.default_limit = default_limit
+        self.window = window
+        self.rolling_days = rolling_days
+
+    @property
+    def period_text(self) -> str:
+        return "در این ماه" if self.window == "calendar_month" else f"در {self.rolling_days} روز اخیر"
+
+    def month_start(self, now: float = None) -> int:
+        now = time.time() if now is None else now
+        return int(datetime.datetime.fromtimestamp(now).replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+    def window_start(self, now: float = None) -> int:
+        now = time.time() if now is None else now
+        return int(now) - self.rolling_days * 86400
+
+    async def remaining(self, db, user_id: int, user_data) -> int:
+        # Reads the quota left without consuming it; the calendar month needs nothing beyond the get_or_create_user row.
+        message_count, period_start, quota_limit = user_data[3], user_data[4], user_data[6]
+        limit = self.default_limit if quota_limit is None else quota_limit
+        if self.window == "rolling":
+            used = await count_questions_since(db, user_id, self.window_start())
+        else:
+            used = 0 if (period_start or 0) < self.month_start() else message_count
+        return max(limit - used, 0)
+
+    async def consume(self, db, user_id: int):
+        # Returns the number of questions left after this one, or None if the quota was already used up.
+        if self.window == "rolling":
+            result = await consume_rolling_quota(db, user_id, self.window_start(), int(time.time()), self.default_limit)
+        else:
+            month_start = self.month_start()
+            result = await consume_quota(db, user_id, month_start, month_start, self.default_limit)
+        if result is None:
+            return None
+        message_count, limit = result
+        return max(limit - message_count, 0)
@@ -0,0 +1,180 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from db import (get_or_create_user, get_pending_sla_questions, get_question_sla_state, mark_question_reminded,
+                reassign_question, record_question_escalation, assign_consultant_to_user,
+                increment_assigned_count, unit_of_work)
+from outbox import PRIORITY_QUESTION, PRIORITY_PROMPT
+
+REMIND = "remind"
+REASSIGN = "reassign"
+
+class SLAScheduler:
+    """Reminds consultants about unanswered questions and hands overdue ones to another consultant.
+
+    Every open question has one timer in a heap ordered by due time, so the loop only ever
+    looks at the earliest deadline and sleeps until then; the heap is rebuilt from the
+    questions table at startup. Answers are applied lazily: an entry is checked against its
+    question row when it fires and dropped if the question was answered or moved meanwhile.
+    """
+
+    def __init__(self, db, outbox, assigner, owner_id: int, remind_after: float, reassign_after: float,
+                 format_question, active: bool = True, sync_interval: float = 0):
+        self.db = db
+        self.outbox = outbox
+        self.assigner = assigner
+        self.owner_id = owner_id
+        self.remind_after = remind_after
+        self.reassign_after = reassign_after
+        self.format_question = format_question
+        # Only one process may act on the timers; the others leave their questions to the periodic sync.
+        self.active = active
+        self.sync_interval = sync_interval
+        self._timers = []
+        self._tracked = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._last_synced_id = 0
+        self._next_sync = 0
+        self._worker = None
+
+    def __len__(self):
+        return len(self._tracked)
+
+    async def start(self):
+        if not self.active:
+            return
+        await self._sync()
+        self._next_sync = time.time() + self.sync_interval
+        if self._tracked:
+            logging.info(f"SLA scheduler restored {len(self._tracked)} open questions")
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+
+    def track(self, question_id: int, consultant_id: int, assigned_at: int = None, reminded: bool = False):
+        if not self.active:
+            return
+        assigned_at = int(time.time()) if assigned_at is None else assigned_at
+        self._tracked[question_id] = assigned_at
+        if reminded or self.remind_after >= self.reassign_after:
+            kind, due = REASSIGN, assigned_at + self.reassign_after
+        else:
+            kind, due = REMIND, assigned_at + self.remind_after
+        entry = (due, next(self._seq), question_id, consultant_id, assigned_at, kind)
+        heapq.heappush(self._timers, entry)
+        if self._timers[0] is entry:
+            self._wakeup.set()
+
+    def resolve(self, question_id: int):
+        # The heap entry stays behind and is discarded when it comes due.
+        self._tracked.pop(question_id, None)
+
+    async def _sync(self):
+        # Picks up questions committed by other processes; ids grow monotonically, so only newer rows are read.
+        for question_id, consultant_id, assigned_at, reminded in await get_pending_sla_questions(self.db, self._last_synced_id):
+            self._last_synced_id = question_id
+            if question_id not in self._tracked:
+                self.track(question_id, consultant_id, assigned_at, bool(reminded))
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            if self.sync_interval and now >= self._next_sync:
+                self._next_sync = now + self.sync_interval
+                try:
+                    await self._sync()
+                except Exception as e:
+                    logging.error(f"SLA scheduler sync failed: {e}")
+                continue
+
+            if self._timers and self._timers[0][0] <= now:
+                entry = heapq.heappop(self._timers)
+                try:
+                    await self._fire(*entry[2:])
+                except Exception as e:
+                    logging.error(f"SLA scheduler failed to handle question {entry[2]}: {e}")
+                continue
+
+            deadlines = [self._timers[0][0]] if self._timers else []
+            if self.sync_interval:
+                deadlines.append(self._next_sync)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), min(deadlines) - now if deadlines else None)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, question_id: int, consultant_id: int, assigned_at: int, kind: str):
+        if self._tracked.get(question_id) != assigned_at:
+            return
+        state = await get_question_sla_state(self.db, question_id)
+        if state is None or state[4] not in ("open", "failed") or state[1] != consultant_id or state[2] != assigned_at:
+            # Answered, or moved by someone else since this timer was set.
+            self._tracked.pop(question_id, None)
+            return
+
+        # A consultant who never received the question can't act on a reminder.
+        if kind == REMIND and state[4] == "open":
+            await self.outbox.send(
+                consultant_id,
+                f"⏰ یادآوری: سوال کاربر <code>{state[0]}</code> هنوز بی‌پاسخ مانده است.\n"
+                f"لطفاً با ریپلای روی پیام سوال به آن پاسخ دهید؛ در غیر این صورت سوال به مشاور دیگری سپرده می‌شود.",
+                PRIORITY_PROMPT
+            )
+            await mark_question_reminded(self.db, question_id)
+            self.track(question_id, consultant_id, assigned_at, reminded=True)
+            return
+
+        await self._reassign(question_id, state)
+
+    async def _reassign(self, question_id: int, state):
+        user_id, old_consultant_id, assigned_at, _, status, question_text, escalations = state
+        now = int(time.time())
+        waited_hours = (now - assigned_at) / 3600
+
+        if not any(cid != old_consultant_id for cid in self.assigner.consultant_ids):
+            await record_question_escalation(self.db, question_id, now)
+            self.track(question_id, old_consultant_id, now, reminded=True)
+            await self._notify_owner(
+                f"🚨 سوال کاربر <code>{user_id}</code> پس از {waited_hours:.0f} ساعت هنوز توسط مشاور "
+                f"<code>{old_consultant_id}</code> پاسخ داده نشده و مشاور دیگری برای انتقال آن وجود ندارد."
+            )
+            return
+
+        new_consultant_id = await self.assigner.pick(self.db, exclude=(old_consultant_id,))
+        try:
+            user_data = await get_or_create_user(self.db, user_id)
+            text = self.format_question(user_id, user_data[0], user_data[1], user_data[2], None, question_text)
+            async with unit_of_work(self.db):
+                await reassign_question(self.db, question_id, new_consultant_id, now)
+                await assign_consultant_to_user(self.db, user_id, new_consultant_id)
+                await increment_assigned_count(self.db, new_consultant_id)
+                await self.outbox.send(new_consultant_id, text, PRIORITY_QUESTION, question_id=question_id)
+        except Exception:
+            self.assigner.release(new_consultant_id)
+            raise
+        # Failed deliveries were already released by the outbox.
+        if status == "open":
+            self.assigner.release(old_consultant_id)
+        self.track(question_id, new_consultant_id, now)
+
+        await self.outbox.send(
+            old_consultant_id,
+            f"ℹ️ سوال کاربر <code>{user_id}</code> به دلیل عدم پاسخ در مهلت مقرر به مشاور دیگری سپرده شد.",
+            PRIORITY_PROMPT
+        )
+        await self._notify_owner(
+            f"🚨 سوال کاربر <code>{user_id}</code> پس از {waited_hours:.0f} ساعت بی‌پاسخ ماند و از مشاور "
+            f"<code>{old_consultant_id}</code> به مشاور <code>{new_consultant_id}</code> منتقل شد "
+            f"(انتقال شماره {escalations + 1})."
+        )
+
+    async def _notify_owner(self, text: str):
+        if self.owner_id:
+            await self.outbox.send(self.owner_id, text, PRIORITY_PROMPT)
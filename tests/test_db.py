@@ -0,0 +1,116 @@
+import asyncio
+import os
+import time
+
+os.environ.setdefault("BOT_TOKEN_PSYCHOLOGY", "1:TEST")
+os.environ.setdefault("OWNER_ID", "1")
+os.environ.setdefault("CONSULTANT_IDS_PSYCHOLOGY", "10")
+
+from db import (Database, migrate, unit_of_work, increment_assigned_count, create_question, get_question_sla_state,
+                get_or_create_user, enqueue_outbox_message, get_pending_outbox_messages, create_broadcast)
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+def test_unit_of_work_with_group_commit(tmp_path):
+    async def scenario():
+        async with Database(str(tmp_path / "bot.db"), group_commit_ms=5) as db:
+            await migrate(db)
+            async with unit_of_work(db):
+                await increment_assigned_count(db, 10)
+                question_id = await create_question(db, 5, 10, None, "question")
+            return await get_question_sla_state(db, question_id)
+    assert run(scenario()) is not None
+
+def test_unit_of_work_rolls_back_on_error(tmp_path):
+    async def scenario():
+        async with Database(str(tmp_path / "bot.db"), group_commit_ms=5) as db:
+            await migrate(db)
+            try:
+                async with unit_of_work(db):
+                    question_id = await create_question(db, 5, 10, None, "question")
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            return await get_question_sla_state(db, question_id)
+    assert run(scenario()) is None
+
+def test_cancelled_unit_of_work_keeps_writer_alive(tmp_path):
+    async def scenario():
+        async with Database(str(tmp_path / "bot.db")) as db:
+            await migrate(db)
+            started = asyncio.Event()
+
+            async def cancelled_unit():
+                async with unit_of_work(db):
+                    await create_question(db, 5, 10, None, "question")
+                    started.set()
+                    await asyncio.sleep(10)
+
+            task = asyncio.create_task(cancelled_unit())
+            await started.wait()
+            task.cancel()
+            # The second cancel lands while the unit of work waits in _end() for its rollback.
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return await create_question(db, 6, 10, None, "question")
+    assert run(scenario())
+
+def test_rolling_quota_counts_questions_in_window(tmp_path):
+    from quota import QuotaPolicy
+
+    async def scenario():
+        async with Database(str(tmp_path / "bot.db")) as db:
+            await migrate(db)
+            await get_or_create_user(db, 5)
+            policy = QuotaPolicy(2, "rolling", 30)
+            # A question from before the window no longer counts.
+            await create_question(db, 5, 10, None, "old", int(time.time()) - 31 * 86400)
+            results = []
+            for _ in range(3):
+                async with unit_of_work(db):
+                    remaining = await policy.consume(db, 5)
+                    if remaining is not None:
+                        await create_question(db, 5, 10, None, "question")
+                results.append(remaining)
+            return results, await policy.remaining(db, 5, await get_or_create_user(db, 5))
+    assert run(scenario()) == ([1, 0, None], 0)
+
+def test_worker_zero_adopts_outbox_rows_of_stopped_workers(tmp_path):
+    async def scenario():
+        async with Database(str(tmp_path / "bot.db")) as db:
+            await migrate(db)
+            for owner in range(3):
+                await enqueue_outbox_message(db, owner, 5, f"from {owner}", None, 0, None)
+            # Down from three workers to two: worker 0 takes over worker 2's row, worker 1 keeps its own.
+            first = [row[2] for row in await get_pending_outbox_messages(db, 0, 2)]
+            second = [row[2] for row in await get_pending_outbox_messages(db, 1, 2)]
+            return first, second
+    assert run(scenario()) == (["from 0", "from 2"], ["from 1"])
+
+def test_only_one_broadcast_runs_at_a_time(tmp_path):
+    async def scenario():
+        async with Database(str(tmp_path / "bot.db")) as db:
+            await migrate(db)
+            return await asyncio.gather(*(create_broadcast(db, "hello", 0, 1) for _ in range(2)))
+    first, second = run(scenario())
+    assert first is not None and second is None
+
+def test_daily_stats_backfill_counts_instant_answers(tmp_path):
+    from analytics import LATENCY_COLUMNS
+    from db import _create_daily_stats
+
+    async def scenario():
+        # Like prepare_database, without a read pool, so the migration step sees its own uncommitted DDL.
+        async with Database(str(tmp_path / "bot.db"), read_pool_size=0) as db:
+            await migrate(db)
+            # A question answered in the second it was asked, then the stats rebuilt from the ledger.
+            await db.execute("INSERT INTO questions (user_id, consultant_id, question_text, asked_at, answered_at, status) "
+                             "VALUES (5, 10, 'q', 1700000000, 1700000000, 'answered')")
+            await db.execute("DROP TABLE consultant_daily_stats")
+            await _create_daily_stats(db)
+            await db.commit()
+            async with db.execute(f"SELECT answered, {LATENCY_COLUMNS[0]} FROM consultant_daily_stats") as cursor:
+                return await cursor.fetchone()
+    assert tuple(run(scenario())) == (1, 1)